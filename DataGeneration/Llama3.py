@@ -1,4 +1,8 @@
 from models import Model
+from prompt_creator import emotion_words_V1, strip_leading_boundary, word_boundary
+from response_cache import cached, cached_batch
+from tracing import tracer
+import copy
 import logging
 import torch
 import transformers
@@ -7,32 +11,136 @@ from transformers import (
     LlamaForCausalLM,
     GenerationConfig,
     BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
 
 logger = logging.getLogger(__name__)
 
+# "beam" is the setup used for the paper. The other modes are meant for the
+# single word answers the templates ask for: greedy decoding that stops at
+# the first word boundary, optionally restricted to the eight I1 emotions.
+decoding_modes = {
+    "beam": {
+        "do_sample": True,
+        "temperature": 0.1,
+        "top_p": 0.9,
+        "top_k": 40,
+        "num_beams": 4,
+        "max_new_tokens": 128,
+    },
+    "greedy": {
+        "do_sample": False,
+        "num_beams": 1,
+        "max_new_tokens": 16,
+        "stop_at_word_boundary": True,
+    },
+    "constrained": {
+        "do_sample": False,
+        "num_beams": 1,
+        "max_new_tokens": 16,
+        "stop_at_word_boundary": True,
+        "allowed_words": emotion_words_V1,
+    },
+    # no generation at all: every I1 emotion is scored as the complete answer
+    "score": {
+        "score_candidates": emotion_words_V1,
+    },
+}
+
+
+class WordBoundaryStoppingCriteria(StoppingCriteria):
+    """Stop a sequence once its generated text contains a complete word."""
+
+    def __init__(self, tokenizer, prompt_length) -> None:
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+
+    def __call__(self, input_ids, scores, **kwargs):
+        texts = self.tokenizer.batch_decode(
+            input_ids[:, self.prompt_length :], skip_special_tokens=True
+        )
+        return torch.tensor(
+            [word_boundary.search(strip_leading_boundary(text)) is not None for text in texts],
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+class AllowedWordsTrie:
+    """
+    Token level trie of the allowed answers, used as `prefix_allowed_tokens_fn`
+    so that generation can only spell out one of the words and then stop.
+    """
+
+    def __init__(self, tokenizer, words, terminators, prompt_length) -> None:
+        self.prompt_length = prompt_length
+        self.terminators = list(terminators)
+        self.children = {}
+        for word in words:
+            token_ids = tokenizer(word, add_special_tokens=False)["input_ids"]
+            for i in range(len(token_ids)):
+                self.children.setdefault(tuple(token_ids[:i]), set()).add(token_ids[i])
+            self.children.setdefault(tuple(token_ids), set()).update(self.terminators)
+
+    def __call__(self, batch_id, input_ids):
+        generated = tuple(input_ids[self.prompt_length :].tolist())
+        allowed = self.children.get(generated)
+        return list(allowed) if allowed else self.terminators
+
 
 class Llama3(Model):
-    def __init__(self, model_name, device, token) -> None:
+    def __init__(
+        self,
+        model_name,
+        device,
+        token,
+        load_in_4bit=True,
+        reuse_prefix_cache=True,
+        pricing=(0.0, 0.0),
+    ) -> None:
         super().__init__()
         self.model_name = model_name
+        # (input, output) cost per token, e.g. the amortized price of the GPU
+        self.pricing = pricing
         self.device = device
         self.token = token
+        self.load_in_4bit = load_in_4bit
+        self.reuse_prefix_cache = reuse_prefix_cache
+        # rendered system prefix -> (prefix input ids, past key values)
+        self.prefix_caches = {}
+        self.set_decoding_mode("beam")
+
+    def set_decoding_mode(self, mode):
+        if mode not in decoding_modes:
+            raise ValueError(f"Unknown decoding mode: {mode}")
+        self.decoding_mode = mode
+        self.generation_params = dict(decoding_modes[mode])
 
     def activate_model(self):
-        bnb_config = BitsAndBytesConfig(
-            load_in_4bit=True,
-            bnb_4bit_use_double_quant=True,
-            bnb_4bit_quant_type="nf4",
-            bnb_4bit_compute_dtype=torch.bfloat16,
-        )
+        if self.load_in_4bit:
+            bnb_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+            )
+            torch_dtype = torch.bfloat16
+        else:
+            # e.g. small models on CPU, which bitsandbytes doesn't support
+            bnb_config = None
+            torch_dtype = "auto"
 
         self.tokenizer = AutoTokenizer.from_pretrained(
             self.model_name, token=self.token
         )
+        # batched generation needs the prompts aligned to the right edge
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model = LlamaForCausalLM.from_pretrained(
             self.model_name,
-            torch_dtype=torch.bfloat16,
+            torch_dtype=torch_dtype,
             quantization_config=bnb_config,
             device_map=self.device,
             token=self.token,
@@ -41,50 +149,272 @@ class Llama3(Model):
 
         logger.info(f"Model: {self.model_name} is activated.")
 
+    def __split_prompt(self, prompt):
+        """
+        Render a chat and split it into the system prefix shared by every
+        prompt of a (persona, template) pair and the rest of the chat.
+        """
+        text = self.tokenizer.apply_chat_template(
+            prompt, add_generation_prompt=True, tokenize=False
+        )
+        if not self.reuse_prefix_cache or prompt[0]["role"] != "system":
+            return "", text
+        prefix = self.tokenizer.apply_chat_template(prompt[:1], tokenize=False)
+        if not text.startswith(prefix):
+            return "", text
+        return prefix, text[len(prefix) :]
+
+    def __get_prefix_cache(self, prefix):
+        if prefix not in self.prefix_caches:
+            prefix_ids = self.tokenizer(
+                prefix, add_special_tokens=False, return_tensors="pt"
+            )["input_ids"].to(self.device)
+            with torch.no_grad(), tracer.span("prefix_cache"):
+                past_key_values = self.model(
+                    prefix_ids, use_cache=True
+                ).past_key_values
+            self.prefix_caches[prefix] = (prefix_ids, past_key_values)
+            logger.info(f"Cached {prefix_ids.shape[-1]} prefix tokens")
+        return self.prefix_caches[prefix]
+
+    def __generate(
+        self,
+        prefix,
+        texts,
+        max_new_tokens,
+        generation_config,
+        stop_at_word_boundary=False,
+        allowed_words=None,
+    ):
+        # the chat template already contains the begin of text token
+        with tracer.span("tokenize", prompts=len(texts)):
+            inputs = self.tokenizer(
+                texts, padding=True, add_special_tokens=False, return_tensors="pt"
+            ).to(self.device)
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs["attention_mask"]
+        generate_kwargs = {}
+        if prefix:
+            # the cached prefix is put in front of the left-padded rest of
+            # the chats; the padding in between is masked out, so every chat
+            # continues at the right position after the prefix
+            prefix_ids, past_key_values = self.__get_prefix_cache(prefix)
+            batch_size = input_ids.shape[0]
+            input_ids = torch.cat([prefix_ids.expand(batch_size, -1), input_ids], dim=-1)
+            attention_mask = torch.cat(
+                [
+                    torch.ones(
+                        batch_size,
+                        prefix_ids.shape[-1],
+                        dtype=attention_mask.dtype,
+                        device=attention_mask.device,
+                    ),
+                    attention_mask,
+                ],
+                dim=-1,
+            )
+            # generate extends the cache in place, so every call gets a copy;
+            # the cache isn't expanded for beam search by generate itself
+            past_key_values = copy.deepcopy(past_key_values)
+            past_key_values.batch_repeat_interleave(
+                batch_size * generation_config.num_beams
+            )
+            generate_kwargs["past_key_values"] = past_key_values
+        terminators = [
+            token_id
+            for token_id in (
+                self.tokenizer.eos_token_id,
+                self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
+            )
+            if token_id is not None and token_id != self.tokenizer.unk_token_id
+        ]
+        prompt_length = input_ids.shape[-1]
+        if stop_at_word_boundary:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList(
+                [WordBoundaryStoppingCriteria(self.tokenizer, prompt_length)]
+            )
+        if allowed_words:
+            generate_kwargs["prefix_allowed_tokens_fn"] = AllowedWordsTrie(
+                self.tokenizer, allowed_words, terminators, prompt_length
+            )
+
+        with torch.no_grad(), tracer.span("generate", prompts=len(texts)):
+            outputs = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_new_tokens,
+                generation_config=generation_config,
+                eos_token_id=terminators,
+                pad_token_id=self.tokenizer.pad_token_id,
+                **generate_kwargs,
+            )
+            responses = outputs[:, input_ids.shape[-1] :]
+
+        input_tokens = attention_mask.sum(dim=-1).tolist()
+        output_tokens = (
+            (responses != self.tokenizer.pad_token_id).sum(dim=-1).tolist()
+        )
+        with tracer.span("decode", prompts=len(texts)):
+            contents = self.tokenizer.batch_decode(responses, skip_special_tokens=True)
+        if stop_at_word_boundary:
+            contents = [
+                word_boundary.split(strip_leading_boundary(content))[0] for content in contents
+            ]
+
+        return [
+            {
+                "content": content,
+                "input_tokens": input_count,
+                "output_tokens": output_count,
+            }
+            for content, input_count, output_count in zip(
+                contents, input_tokens, output_tokens
+            )
+        ]
+
     def __evaluate(
         self,
-        prompt,
-        temperature=0.1,
-        top_p=0.9,
-        top_k=40,
+        prompts,
+        do_sample=True,
         num_beams=4,
         max_new_tokens=128,
+        stop_at_word_boundary=False,
+        allowed_words=None,
         **kwargs,
     ):
-        input_ids = self.tokenizer.apply_chat_template(
-            prompt, add_generation_prompt=True, return_tensors="pt"
-        ).to(self.device)
-        terminators = [
-            self.tokenizer.eos_token_id,
-            self.tokenizer.convert_tokens_to_ids("<|eot_id|>"),
-        ]
-
         generation_config = GenerationConfig(
-            temperature=temperature,
-            top_p=top_p,
-            top_k=top_k,
+            do_sample=do_sample,
             num_beams=num_beams,
             **kwargs,
         )
 
-        with torch.no_grad():
-            outputs = self.model.generate(
-                input_ids,
-                do_sample=True,
-                max_new_tokens=max_new_tokens,
-                generation_config=generation_config,
-                eos_token_id=terminators,
+        # prompts sharing a system prefix are generated together on top of
+        # that prefix's cached key/values
+        groups = {}
+        for i, prompt in enumerate(prompts):
+            prefix, rest = self.__split_prompt(prompt)
+            groups.setdefault(prefix, []).append((i, rest))
+
+        responses = [None] * len(prompts)
+        for prefix, items in groups.items():
+            group_responses = self.__generate(
+                prefix,
+                [rest for _, rest in items],
+                max_new_tokens,
+                generation_config,
+                stop_at_word_boundary=stop_at_word_boundary,
+                allowed_words=allowed_words,
             )
-            response = outputs[0][input_ids.shape[-1] :]
+            for (i, _), response in zip(items, group_responses):
+                responses[i] = response
+        return responses
 
-        return self.tokenizer.decode(response, skip_special_tokens=True)
+    def __score(self, prompt, candidates):
+        """
+        Log-likelihood of each candidate as the complete answer to `prompt`,
+        i.e. the candidate's tokens followed by the end of turn token. The
+        prompt is run once and all candidates are scored in one batched
+        forward pass on top of its key/value cache.
+        """
+        prefix, rest = self.__split_prompt(prompt)
+        with tracer.span("tokenize", prompts=1):
+            rest_ids = self.tokenizer(
+                rest, add_special_tokens=False, return_tensors="pt"
+            )["input_ids"].to(self.device)
+        past_key_values = None
+        prompt_length = rest_ids.shape[-1]
+        if prefix:
+            prefix_ids, past_key_values = self.__get_prefix_cache(prefix)
+            past_key_values = copy.deepcopy(past_key_values)
+            prompt_length += prefix_ids.shape[-1]
+
+        end_of_turn = self.tokenizer.convert_tokens_to_ids("<|eot_id|>")
+        if end_of_turn is None or end_of_turn == self.tokenizer.unk_token_id:
+            end_of_turn = self.tokenizer.eos_token_id
+        candidate_ids = [
+            self.tokenizer(candidate, add_special_tokens=False)["input_ids"]
+            + [end_of_turn]
+            for candidate in candidates
+        ]
+        longest = max(len(ids) for ids in candidate_ids)
+        padded_ids = torch.full(
+            (len(candidates), longest), self.tokenizer.pad_token_id, device=self.device
+        )
+        candidate_mask = torch.zeros(
+            (len(candidates), longest), dtype=torch.long, device=self.device
+        )
+        for i, ids in enumerate(candidate_ids):
+            padded_ids[i, : len(ids)] = torch.tensor(ids, device=self.device)
+            candidate_mask[i, : len(ids)] = 1
 
+        with torch.no_grad(), tracer.span("score", candidates=len(candidates)):
+            prompt_outputs = self.model(
+                rest_ids, past_key_values=past_key_values, use_cache=True
+            )
+            past_key_values = prompt_outputs.past_key_values
+            past_key_values.batch_repeat_interleave(len(candidates))
+            # candidates are padded on the right, so the padding never
+            # affects the positions of the tokens that are scored
+            attention_mask = torch.cat(
+                [
+                    torch.ones(
+                        (len(candidates), prompt_length),
+                        dtype=torch.long,
+                        device=self.device,
+                    ),
+                    candidate_mask,
+                ],
+                dim=-1,
+            )
+            candidate_outputs = self.model(
+                padded_ids,
+                past_key_values=past_key_values,
+                attention_mask=attention_mask,
+            )
+
+        # the prompt's last logits predict the first candidate token and the
+        # candidate logits at position j predict token j + 1
+        logits = torch.cat(
+            [
+                prompt_outputs.logits[:, -1:].expand(len(candidates), -1, -1),
+                candidate_outputs.logits[:, :-1],
+            ],
+            dim=1,
+        )
+        log_probs = torch.log_softmax(logits.float(), dim=-1)
+        token_log_probs = log_probs.gather(-1, padded_ids.unsqueeze(-1)).squeeze(-1)
+        scores = (token_log_probs * candidate_mask).sum(dim=-1)
+        probabilities = torch.softmax(scores, dim=-1).tolist()
+
+        return {
+            "content": candidates[int(scores.argmax())],
+            "distribution": dict(zip(candidates, probabilities)),
+            "input_tokens": prompt_length,
+            "output_tokens": 0,
+        }
+
+    def __respond(self, prompts):
+        if "score_candidates" in self.generation_params:
+            candidates = self.generation_params["score_candidates"]
+            return [self.__score(prompt, candidates) for prompt in prompts]
+        return self.__evaluate(prompts=prompts, **self.generation_params)
+
+    @cached
     def create_response(self, model_message):
-        content = self.__evaluate(prompt=model_message)
+        return self.__respond([model_message])[0]
 
-        response = {"content": content}
+    @cached_batch
+    def create_batch_response(self, model_messages):
+        return self.__respond(model_messages)
 
-        return response
+    def count_tokens(self, model_message):
+        if getattr(self, "tokenizer", None) is None:
+            return super().count_tokens(model_message)
+        text = self.tokenizer.apply_chat_template(
+            model_message, add_generation_prompt=True, tokenize=False
+        )
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
 
     def calculate_cost(self, input_tokens, output_tokens):
-        return 0.0
+        input_cost, output_cost = self.pricing
+        return input_cost * input_tokens + output_cost * output_tokens
@@ -0,0 +1,232 @@
+"""
+Running emotion counts of a result store.
+
+`EmotionCounts` keeps the number of responses per (model, prompt version,
+persona, emotion) in a small SQLite file next to the result store. An update
+only reads the rows saved since the previous one; a response that replaces
+an earlier one for the same key (e.g. after replaying dead letters) moves
+its count from the old emotion to the new one. The top-k lists that
+`GraphGeneration/spider_chart.py` plots are written from these counts:
+
+    $ python aggregation.py update --store ../Data/results.sqlite --counts ../Data/emotion_counts.sqlite \
+        --ordered_list_folder ../GraphGeneration/
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+from postprocess import ResponseNormalizer, load_substitutions
+from result_store import ResultStore
+
+logger = logging.getLogger(__name__)
+
+key_columns = ["id", "persona", "model", "prompt_version"]
+count_columns = ["model", "prompt_version", "persona", "emotion"]
+# column of the ordered lists per persona
+persona_columns = {"man": "male_count", "woman": "female_count"}
+
+
+class EmotionCounts:
+    def __init__(self, path, normalizer: ResponseNormalizer = None) -> None:
+        self.path = path
+        # without a normalizer the stripped responses are counted as they are
+        self.normalizer = normalizer
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS counts (
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                persona TEXT NOT NULL,
+                emotion TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (model, prompt_version, persona, emotion)
+            );
+            CREATE TABLE IF NOT EXISTS latest (
+                id TEXT NOT NULL,
+                persona TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                emotion TEXT NOT NULL,
+                PRIMARY KEY (id, persona, model, prompt_version)
+            );
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            """
+        )
+        self.connection.commit()
+
+    def watermark(self):
+        """rowid of the last result store row that is counted."""
+        row = self.connection.execute(
+            "SELECT value FROM state WHERE key = 'watermark'"
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def __emotions(self, responses: pd.Series) -> pd.Series:
+        if self.normalizer is not None:
+            return self.normalizer.resolve_series(responses)
+        return responses.fillna("").astype(str).str.strip()
+
+    def __previous_emotions(self, keys: pd.DataFrame) -> pd.DataFrame:
+        self.connection.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS incoming (id TEXT, persona TEXT, model TEXT, prompt_version INTEGER)"
+        )
+        self.connection.execute("DELETE FROM incoming")
+        self.connection.executemany(
+            "INSERT INTO incoming VALUES (?, ?, ?, ?)",
+            keys[key_columns].itertuples(index=False, name=None),
+        )
+        rows = self.connection.execute(
+            """SELECT latest.id, latest.persona, latest.model, latest.prompt_version, latest.emotion
+            FROM latest JOIN incoming USING (id, persona, model, prompt_version)"""
+        ).fetchall()
+        return pd.DataFrame(rows, columns=key_columns + ["emotion"])
+
+    def update(self, store: ResultStore):
+        """Count the rows saved to `store` since the last update; returns their number."""
+        with self.lock:
+            changes = store.changes(self.watermark())
+            if changes.empty:
+                return 0
+            watermark = int(changes["rowid"].max())
+            # only the latest row of a key saved more than once counts
+            changes = changes.drop_duplicates(key_columns, keep="last")
+            changes = changes.assign(emotion=self.__emotions(changes["content"]))
+
+            previous = self.__previous_emotions(changes)
+            deltas = pd.concat(
+                [
+                    changes.groupby(count_columns).size(),
+                    -previous.groupby(count_columns).size(),
+                ]
+            )
+            deltas = deltas.groupby(level=list(range(len(count_columns)))).sum()
+            deltas = deltas[deltas != 0]
+
+            self.connection.executemany(
+                """INSERT INTO counts VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (model, prompt_version, persona, emotion)
+                DO UPDATE SET count = count + excluded.count""",
+                (
+                    (model, int(prompt_version), persona, emotion, int(delta))
+                    for (model, prompt_version, persona, emotion), delta in deltas.items()
+                ),
+            )
+            self.connection.execute("DELETE FROM counts WHERE count = 0")
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?, ?)",
+                changes[key_columns + ["emotion"]].itertuples(index=False, name=None),
+            )
+            self.connection.execute(
+                "INSERT OR REPLACE INTO state VALUES ('watermark', ?)", (watermark,)
+            )
+            self.connection.commit()
+        logger.info(f"Counted {len(changes)} responses up to row {watermark}")
+        return len(changes)
+
+    def rebuild(self, store: ResultStore):
+        """Count the whole store again, e.g. after the substitutions changed."""
+        with self.lock:
+            self.connection.executescript(
+                "DELETE FROM counts; DELETE FROM latest; DELETE FROM state;"
+            )
+            self.connection.commit()
+        return self.update(store)
+
+    def counts(self, model=None, prompt_version=None) -> pd.DataFrame:
+        conditions = []
+        parameters = []
+        if model is not None:
+            conditions.append("model = ?")
+            parameters.append(model)
+        if prompt_version is not None:
+            conditions.append("prompt_version = ?")
+            parameters.append(int(prompt_version))
+        query = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT model, prompt_version, persona, emotion, count FROM counts{query}",
+                parameters,
+            ).fetchall()
+        return pd.DataFrame(rows, columns=count_columns + ["count"])
+
+    def prompt_versions(self):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT DISTINCT prompt_version FROM counts ORDER BY prompt_version"
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def ordered_list(self, prompt_version, k=8, model=None, emotions=None) -> pd.DataFrame:
+        """
+        Male and female counts of the `k` most frequent emotions (over both
+        personas and every model unless `model` is given), most frequent
+        first. With `emotions`, those are listed in the given order instead.
+        """
+        counts = self.counts(model, prompt_version)
+        counts = counts[(counts["emotion"] != "") & counts["persona"].isin(persona_columns)]
+        table = counts.pivot_table(
+            index="emotion", columns="persona", values="count", aggfunc="sum", fill_value=0
+        )
+        table = table.reindex(columns=list(persona_columns), fill_value=0)
+        if emotions is None:
+            table = table.loc[table.sum(axis=1).sort_values(ascending=False, kind="stable").index[:k]]
+        else:
+            table = table.reindex(emotions, fill_value=0)
+        table = table.rename(columns=persona_columns).reset_index()
+        table.columns.name = None
+        return table[["emotion", "male_count", "female_count"]]
+
+
+def write_ordered_lists(counts: EmotionCounts, folder, k=8, model=None):
+    """Write `ordered_list_I<version>_latest.csv` for every prompt version."""
+    paths = []
+    for prompt_version in counts.prompt_versions():
+        path = os.path.join(folder, f"ordered_list_I{prompt_version}_latest.csv")
+        counts.ordered_list(prompt_version, k=k, model=model).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+
+def create_emotion_counts(path, substitutions_path=None):
+    substitutions = load_substitutions(substitutions_path) if substitutions_path else {}
+    return EmotionCounts(path, ResponseNormalizer(substitutions))
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["update", "rebuild"])
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--counts", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, default=None)
+    parser.add_argument("--ordered_list_folder", type=str, default=None)
+    parser.add_argument("--top_k", type=int, default=8)
+    parser.add_argument("--model", type=str, default=None, help="count a single model only")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    counts = create_emotion_counts(args.counts, args.substitutions)
+    store = ResultStore(args.store)
+    if args.command == "rebuild":
+        counted = counts.rebuild(store)
+    else:
+        counted = counts.update(store)
+    print(f"Counted {counted} new responses")
+    if args.ordered_list_folder is not None:
+        for path in write_ordered_lists(
+            counts, args.ordered_list_folder, k=args.top_k, model=args.model
+        ):
+            print(f"Wrote {path}")
@@ -0,0 +1,374 @@
+"""
+Bulk generation through the OpenAI Batch API.
+
+Every pending (ID, persona) prompt is written to a JSONL batch file and
+submitted as one job; the job is polled until it finishes and its results
+are fanned back out through `DataHandler.save_model_response`. Submitted
+jobs are recorded in `batch_state.json` inside the batch folder, so an
+interrupted run picks up the jobs it already paid for instead of sending the
+prompts again.
+"""
+
+from abc import ABC, abstractmethod
+from datetime import datetime
+import json
+import logging
+import os
+import time
+import uuid
+
+from openai import OpenAI
+
+from data_handler import DataHandlerBase, sanitize_model_name
+from metrics import UsageMetrics
+from models import Model
+from prompt_creator import PromptCreator
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# the Batch API is billed at half the price of the synchronous endpoint
+batch_discount = 0.5
+max_requests_per_batch = 50000
+terminal_states = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchClient(ABC):
+    @abstractmethod
+    def submit(self, batch_file_path) -> str:
+        pass
+
+    @abstractmethod
+    def status(self, batch_id) -> str:
+        pass
+
+    @abstractmethod
+    def results(self, batch_id):
+        pass
+
+
+class OpenAIBatchClient(BatchClient):
+    def __init__(self, key, base_url=None) -> None:
+        self.client = OpenAI(api_key=key, base_url=base_url)
+
+    def submit(self, batch_file_path) -> str:
+        with open(batch_file_path, "rb") as file:
+            batch_file = self.client.files.create(file=file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id) -> str:
+        return self.client.batches.retrieve(batch_id).status
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+class LocalBatchClient(BatchClient):
+    """
+    Runs a batch file against a `Model` on this machine and reports it in the
+    Batch API output format. Useful with `mock_server.py` for testing the
+    batch flow without an OpenAI account, or for backends that have no batch
+    endpoint of their own.
+    """
+
+    def __init__(self, model: Model) -> None:
+        self.model = model
+        self.batches = {}
+
+    def submit(self, batch_file_path) -> str:
+        batch_id = f"batch_{uuid.uuid4().hex}"
+        self.batches[batch_id] = batch_file_path
+        return batch_id
+
+    def status(self, batch_id) -> str:
+        return "completed"
+
+    def results(self, batch_id):
+        with open(self.batches[batch_id], "r", encoding="utf-8") as file:
+            for line in file:
+                request = json.loads(line)
+                try:
+                    response = self.model.create_response(request["body"]["messages"])
+                except Exception as e:
+                    yield {
+                        "custom_id": request["custom_id"],
+                        "response": None,
+                        "error": {"message": str(e)},
+                    }
+                    continue
+                yield {
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": response["content"],
+                                    },
+                                }
+                            ],
+                            "usage": {
+                                "prompt_tokens": response.get("input_tokens", 0),
+                                "completion_tokens": response.get("output_tokens", 0),
+                                "total_tokens": response.get("total_tokens", 0),
+                            },
+                        },
+                    },
+                    "error": None,
+                }
+
+
+def make_custom_id(index, persona):
+    return f"{index}|{persona}"
+
+
+def parse_custom_id(custom_id):
+    index, persona = custom_id.rsplit("|", 1)
+    return index, persona
+
+
+class BatchState:
+    def __init__(self, batch_folder) -> None:
+        self.path = os.path.join(batch_folder, "batch_state.json")
+        self.batches = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as file:
+                self.batches = json.load(file)
+
+    def add(self, batch_id, batch_file_path):
+        self.batches[batch_id] = batch_file_path
+        self.save()
+
+    def remove(self, batch_id):
+        self.batches.pop(batch_id, None)
+        self.save()
+
+    def save(self):
+        with open(self.path, "w", encoding="utf-8") as file:
+            json.dump(self.batches, file, indent=2)
+
+
+def read_batch_requests(batch_file_path):
+    requests = {}
+    with open(batch_file_path, "r", encoding="utf-8") as file:
+        for line in file:
+            request = json.loads(line)
+            requests[request["custom_id"]] = request["body"]["messages"]
+    return requests
+
+
+def write_batch_files(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    model: Model,
+    batch_folder,
+    total=-1,
+    skip_custom_ids=frozenset(),
+):
+    """
+    Write the pending prompts to JSONL batch files of at most
+    `max_requests_per_batch` requests each and return their paths. Prompts
+    whose response is already in the model's response cache are saved right
+    away instead of being submitted again.
+    """
+    personas = data_handler.get_personas()
+    prompt_version = data_handler.get_prompt_version()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    file_prefix = f"batch_{sanitize_model_name(model.model_name)}_v{prompt_version}_{timestamp}"
+
+    batch_file_paths = []
+    batch_file = None
+    requests_in_file = 0
+    try:
+        for data_point in data_handler.return_data_point(total):
+            for persona in personas:
+                custom_id = make_custom_id(data_point["ID"], persona)
+                if custom_id in skip_custom_ids:
+                    continue
+                prompt = prompt_creator.create_prompt(
+                    prompt=data_point["text"],
+                    persona=persona,
+                    domain=data_point["Domain"],
+                    version=prompt_version,
+                )
+                if model.response_cache is not None:
+                    response = model.response_cache.get(
+                        ResponseCache.make_key(
+                            model.model_name, prompt, model.generation_params
+                        )
+                    )
+                    if response is not None:
+                        data_handler.save_model_response(
+                            response, persona=persona, index=data_point["ID"]
+                        )
+                        continue
+
+                if batch_file is None or requests_in_file == max_requests_per_batch:
+                    if batch_file is not None:
+                        batch_file.close()
+                    batch_file_path = os.path.join(
+                        batch_folder, f"{file_prefix}_{len(batch_file_paths)}.jsonl"
+                    )
+                    batch_file = open(batch_file_path, "w", encoding="utf-8")
+                    batch_file_paths.append(batch_file_path)
+                    requests_in_file = 0
+                request = {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": model.model_name,
+                        "messages": prompt,
+                        **model.generation_params,
+                    },
+                }
+                batch_file.write(json.dumps(request, ensure_ascii=False) + "\n")
+                requests_in_file += 1
+    finally:
+        if batch_file is not None:
+            batch_file.close()
+
+    return batch_file_paths
+
+
+def collect_batch_results(
+    data_handler: DataHandlerBase,
+    model: Model,
+    batch_client: BatchClient,
+    batch_id,
+    batch_file_path,
+    metrics: UsageMetrics = None,
+):
+    """Save the results of a finished batch and return its (input, output) token usage."""
+    requests = read_batch_requests(batch_file_path)
+    prompt_version = data_handler.get_prompt_version()
+    input_tokens = 0
+    output_tokens = 0
+    for result in batch_client.results(batch_id):
+        custom_id = result["custom_id"]
+        index, persona = parse_custom_id(custom_id)
+        response = result.get("response")
+        if result.get("error") or response is None or response["status_code"] != 200:
+            if metrics is not None:
+                metrics.record_error(model, prompt_version, persona)
+            data_handler.save_failed_request(
+                requests.get(custom_id),
+                persona=persona,
+                index=index,
+                error=result.get("error") or response,
+            )
+            continue
+
+        body = response["body"]
+        model_response = {
+            "content": body["choices"][0]["message"]["content"],
+            "total_tokens": body["usage"]["total_tokens"],
+            "input_tokens": body["usage"]["prompt_tokens"],
+            "output_tokens": body["usage"]["completion_tokens"],
+        }
+        # the requests of a batch have no latency of their own
+        if metrics is not None:
+            metrics.record(model, prompt_version, persona, None, model_response)
+        data_handler.save_model_response(model_response, persona=persona, index=index)
+        if model.response_cache is not None and custom_id in requests:
+            model.response_cache.put(
+                ResponseCache.make_key(
+                    model.model_name, requests[custom_id], model.generation_params
+                ),
+                model_response,
+            )
+        input_tokens += model_response["input_tokens"]
+        output_tokens += model_response["output_tokens"]
+
+    return input_tokens, output_tokens
+
+
+def generate_batch_inference_data(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    model: Model,
+    batch_client: BatchClient,
+    batch_folder,
+    total: int = -1,
+    calcualate_cost: bool = False,
+    poll_interval: float = 60,
+    metrics: UsageMetrics = None,
+):
+    if metrics is not None:
+        metrics.set_cost_function(
+            model.model_name,
+            lambda input_tokens, output_tokens: batch_discount
+            * model.calculate_cost(input_tokens, output_tokens),
+        )
+    if not os.path.exists(batch_folder):
+        os.makedirs(batch_folder)
+    state = BatchState(batch_folder)
+
+    # prompts of batches submitted by an earlier run are not sent again
+    submitted_custom_ids = set()
+    for batch_file_path in state.batches.values():
+        submitted_custom_ids.update(read_batch_requests(batch_file_path))
+    if state.batches:
+        logger.info(f"Resuming {len(state.batches)} submitted batches")
+
+    for batch_file_path in write_batch_files(
+        data_handler,
+        prompt_creator,
+        model,
+        batch_folder,
+        total=total,
+        skip_custom_ids=submitted_custom_ids,
+    ):
+        batch_id = batch_client.submit(batch_file_path)
+        state.add(batch_id, batch_file_path)
+        logger.info(f"Submitted batch {batch_id}: {batch_file_path}")
+
+    total_input_tokens = 0
+    total_output_tokens = 0
+    while state.batches:
+        for batch_id, batch_file_path in list(state.batches.items()):
+            status = batch_client.status(batch_id)
+            if status not in terminal_states:
+                continue
+            if status == "failed":
+                logger.error(f"Batch {batch_id} failed")
+                if metrics is not None:
+                    prompt_version = data_handler.get_prompt_version()
+                    for custom_id in read_batch_requests(batch_file_path):
+                        metrics.record_error(model, prompt_version, parse_custom_id(custom_id)[1])
+                state.remove(batch_id)
+                continue
+            # expired and cancelled batches still return the requests that
+            # finished; the rest stay pending for the next run
+            if status != "completed":
+                logger.warning(f"Batch {batch_id} ended with status: {status}")
+            input_tokens, output_tokens = collect_batch_results(
+                data_handler, model, batch_client, batch_id, batch_file_path, metrics
+            )
+            total_input_tokens += input_tokens
+            total_output_tokens += output_tokens
+            state.remove(batch_id)
+            logger.info(f"Collected batch {batch_id}")
+            if calcualate_cost:
+                cost_till_now = batch_discount * model.calculate_cost(
+                    total_input_tokens, total_output_tokens
+                )
+                logger.info(f"Batch {batch_id} done, Total cost: {cost_till_now}")
+        if state.batches:
+            time.sleep(poll_interval)
+
+    return total_input_tokens, total_output_tokens
@@ -0,0 +1,540 @@
+"""
+Offline benchmarks for the generation pipeline.
+
+    $ python benchmark.py decoding --model_path meta-llama/Meta-Llama-3-8B-Instruct --prompts 32
+
+The pipeline scenarios don't need an API key or a GPU. Remote models are
+replaced by `MockModel` (or by `mock_server.py` for the 429 storm), the
+local path runs a tiny random Llama built on the fly, and every run writes
+to a temporary storage folder:
+
+    pipeline      every row x 2 personas through executor.generate_inference_data
+    resume        the same with half of the responses already saved
+    data_handler  DataHandler startup and a full eligibility scan, empty and half done
+    storm         async requests against a mock API whose quota is far too small
+    local         batched Llama3 generation with a tiny CPU model
+    suite         all of the above, each in a fresh process
+
+Each scenario reports throughput, p50/p99 latency, startup time (until the
+first request) and peak RSS; `--output` saves the rows as JSON so runs can
+be compared:
+
+    $ python benchmark.py suite --output ../Data/benchmark.json
+"""
+
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+
+import pandas as pd
+import yaml
+
+from models import Model
+from prompt_creator import ChatGptMessageCreator, emotion_words_V1
+from rate_limiter import estimate_tokens
+from tracing import percentile, print_table, tracer
+
+logger = logging.getLogger(__name__)
+
+
+def sample_prompts(emotion_data_path, prompt_version, total):
+    emotion_df = pd.read_csv(emotion_data_path, nrows=total)
+    message_creator = ChatGptMessageCreator()
+    return [
+        message_creator.create_prompt(
+            prompt=text, persona=persona, version=prompt_version
+        )
+        for text in emotion_df["text"]
+        for persona in ("man", "woman")
+    ][:total]
+
+
+def benchmark_decoding(args):
+    """Per prompt latency of the Llama3 decoding modes on the same prompts."""
+    from Llama3 import Llama3
+
+    model = Llama3(
+        model_name=args.model_path,
+        device=args.device,
+        token=args.token,
+        load_in_4bit=args.load_in_4bit,
+    )
+    model.activate_model()
+    prompts = sample_prompts(args.emotion_data_path, args.prompt_version, args.prompts)
+
+    rows = []
+    for mode in args.modes:
+        model.set_decoding_mode(mode)
+        model.create_response(prompts[0])  # warm up
+        latencies = []
+        output_tokens = 0
+        for prompt in prompts:
+            start = time.perf_counter()
+            response = model.create_response(prompt)
+            latencies.append(time.perf_counter() - start)
+            output_tokens += response["output_tokens"]
+        rows.append(
+            {
+                "mode": mode,
+                "prompts": len(prompts),
+                "mean_ms": f"{1000 * sum(latencies) / len(latencies):.1f}",
+                "p50_ms": f"{1000 * percentile(latencies, 50):.1f}",
+                "p99_ms": f"{1000 * percentile(latencies, 99):.1f}",
+                "output_tokens": f"{output_tokens / len(prompts):.1f}",
+                "example": response["content"].strip()[:20],
+            }
+        )
+    print_table(
+        rows,
+        ["mode", "prompts", "mean_ms", "p50_ms", "p99_ms", "output_tokens", "example"],
+    )
+    return rows
+
+
+class MockServerError(RuntimeError):
+    def __init__(self, status_code=500) -> None:
+        super().__init__(f"Mock server error {status_code}")
+        self.status_code = status_code
+
+
+class MockModel(Model):
+    """
+    Stand-in for a remote model. Every request waits for a latency drawn
+    from `distribution` (`constant`, `exponential` or `lognormal`, with mean
+    `latency` seconds), fails with a 500 at `error_rate` and otherwise
+    answers with a random I1 emotion word. Seeded, so runs are repeatable.
+    """
+
+    def __init__(
+        self,
+        model_name="mock-model",
+        latency=0.05,
+        distribution="lognormal",
+        error_rate=0.0,
+        output_tokens=2,
+        seed=0,
+    ) -> None:
+        super().__init__()
+        if distribution not in ("constant", "exponential", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.model_name = model_name
+        self.latency = latency
+        self.distribution = distribution
+        self.error_rate = error_rate
+        self.output_tokens = output_tokens
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample_latency(self):
+        with self.lock:
+            if self.latency <= 0 or self.distribution == "constant":
+                return max(self.latency, 0.0)
+            if self.distribution == "exponential":
+                return self.random.expovariate(1 / self.latency)
+            sigma = 0.5
+            return self.random.lognormvariate(math.log(self.latency) - sigma**2 / 2, sigma)
+
+    def __answer(self, model_message):
+        with self.lock:
+            failed = self.random.random() < self.error_rate
+            content = self.random.choice(emotion_words_V1)
+        if failed:
+            raise MockServerError()
+        input_tokens = estimate_tokens(model_message, completion_tokens=0)
+        return {
+            "content": content,
+            "total_tokens": input_tokens + self.output_tokens,
+            "input_tokens": input_tokens,
+            "output_tokens": self.output_tokens,
+        }
+
+    def create_response(self, model_message):
+        time.sleep(self.sample_latency())
+        return self.__answer(model_message)
+
+    async def acreate_response(self, model_message):
+        await asyncio.sleep(self.sample_latency())
+        return self.__answer(model_message)
+
+    def calculate_cost(self, input_tokens, output_tokens):
+        return 0.0
+
+
+def build_tiny_model(path, emotion_data_path, vocab_size=2000):
+    """
+    Save a randomly initialised two layer Llama with a BPE tokenizer trained
+    on the dataset and a Llama 3 style chat template, small enough to run the
+    `Llama3` path on a CPU.
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+    import prompt_creator
+
+    if os.path.exists(os.path.join(path, "config.json")):
+        return path
+    special_tokens = [
+        "<|begin_of_text|>",
+        "<|end_of_text|>",
+        "<|start_header_id|>",
+        "<|end_header_id|>",
+        "<|eot_id|>",
+    ]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    texts = pd.read_csv(emotion_data_path, nrows=2000)["text"].tolist()
+    texts += list(prompt_creator.system_instruction_templates.values()) * 20
+    texts += [prompt_creator.prompt_template_V1] * 20
+    tokenizer.train_from_iterator(
+        texts,
+        trainers.BpeTrainer(
+            vocab_size=vocab_size,
+            special_tokens=special_tokens,
+            initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        ),
+    )
+    chat_template = (
+        "{{ bos_token }}{% for message in messages %}"
+        "{{ '<|start_header_id|>' + message['role'] + '<|end_header_id|>\n\n' + message['content'] + '<|eot_id|>' }}"
+        "{% endfor %}{% if add_generation_prompt %}"
+        "{{ '<|start_header_id|>assistant<|end_header_id|>\n\n' }}{% endif %}"
+    )
+    fast_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token="<|begin_of_text|>",
+        eos_token="<|end_of_text|>",
+        chat_template=chat_template,
+    )
+    fast_tokenizer.save_pretrained(path)
+    config = LlamaConfig(
+        vocab_size=len(fast_tokenizer),
+        hidden_size=64,
+        intermediate_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=2048,
+        bos_token_id=fast_tokenizer.bos_token_id,
+        eos_token_id=fast_tokenizer.eos_token_id,
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    return path
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def write_config(folder, emotion_data_path, **config):
+    config = {
+        "model": "mock-model",
+        "prompt_version": 1,
+        "emotion_data_path": os.path.abspath(emotion_data_path),
+        "storage_folder_path": os.path.join(folder, "storage", ""),
+        "dead_letter_path": os.path.join(folder, "dead_letters.jsonl"),
+        **config,
+    }
+    config_file_path = os.path.join(folder, "config.yaml")
+    with open(config_file_path, "w") as f:
+        yaml.safe_dump(config, f)
+    return config_file_path
+
+
+def prefill(data_handler, fraction):
+    """Save a response for the first `fraction` of the dataset, as a crashed run would have."""
+    emotion_df = pd.read_csv(data_handler.get_config_value("emotion_data_path"))
+    for index in emotion_df["ID"][: int(len(emotion_df) * fraction)]:
+        for persona in data_handler.get_personas():
+            data_handler.save_generated_data("রাগ", persona=persona, index=index)
+
+
+def run_generation(scenario, run, rows):
+    """Time `run` and summarise the requests recorded by the metrics and tracer."""
+    from metrics import UsageMetrics
+
+    metrics = UsageMetrics()
+    tracer.enable()
+    started = time.perf_counter()
+    run(metrics)
+    elapsed = time.perf_counter() - started
+    request_starts = [
+        event["ts"] / 1e6
+        for event in tracer.events
+        if event is not None and event["name"] == "request"
+    ]
+    tracer.disable()
+    snapshot = metrics.snapshot()
+    latencies = [
+        latency
+        for series in metrics.series.values()
+        for latency in series.latencies
+    ]
+    requests = snapshot["requests"]
+    return {
+        "scenario": scenario,
+        "rows": rows,
+        "requests": requests,
+        "errors": snapshot["errors"],
+        "seconds": f"{elapsed:.2f}",
+        "requests_per_s": f"{requests / elapsed:.1f}",
+        "p50_ms": f"{1000 * percentile(latencies, 50):.1f}",
+        "p99_ms": f"{1000 * percentile(latencies, 99):.1f}",
+        "startup_s": f"{min(request_starts, default=elapsed):.3f}",
+        "peak_rss_mb": f"{peak_rss_mb():.0f}",
+    }
+
+
+def benchmark_pipeline(args, resume=False):
+    """Every (row, persona) through `generate_inference_data` against a `MockModel`."""
+    from data_handler import create_data_handler
+    from executor import agenerate_inference_data, generate_inference_data
+
+    with tempfile.TemporaryDirectory() as folder:
+        config_file_path = write_config(folder, args.emotion_data_path)
+        if resume:
+            prefill(create_data_handler(config_file_path), 0.5)
+        # the handler is created inside the timed run: reading the
+        # completed responses is part of the startup time
+        model = MockModel(
+            latency=args.latency,
+            distribution=args.latency_distribution,
+            error_rate=args.error_rate,
+            seed=args.seed,
+        )
+
+        def run(metrics):
+            data_handler = create_data_handler(config_file_path)
+            if args.concurrency > 1:
+                asyncio.run(
+                    agenerate_inference_data(
+                        data_handler,
+                        ChatGptMessageCreator(),
+                        model,
+                        total=args.rows,
+                        concurrency=args.concurrency,
+                        metrics=metrics,
+                    )
+                )
+            else:
+                generate_inference_data(
+                    data_handler,
+                    ChatGptMessageCreator(),
+                    model,
+                    total=args.rows,
+                    metrics=metrics,
+                )
+
+        row = run_generation("resume" if resume else "pipeline", run, args.rows)
+    print_table([row], list(row))
+    return [row]
+
+
+def benchmark_resume(args):
+    return benchmark_pipeline(args, resume=True)
+
+
+def benchmark_data_handler(args):
+    """Time until the first pending data point and for a full scan, with an empty and a half full storage."""
+    from data_handler import create_data_handler
+
+    rows = []
+    with tempfile.TemporaryDirectory() as folder:
+        config_file_path = write_config(folder, args.emotion_data_path)
+        for done in (0.0, 0.5):
+            if done:
+                prefill(create_data_handler(config_file_path), done)
+            started = time.perf_counter()
+            data_handler = create_data_handler(config_file_path)
+            data_points = data_handler.return_data_point()
+            next(data_points, None)
+            first = time.perf_counter() - started
+            pending = 1 + sum(1 for _ in data_points)
+            elapsed = time.perf_counter() - started
+            rows.append(
+                {
+                    "scenario": "data_handler",
+                    "done": f"{100 * done:.0f}%",
+                    "pending": pending,
+                    "startup_s": f"{first:.3f}",
+                    "scan_s": f"{elapsed:.3f}",
+                    "rows_per_s": f"{pending / elapsed:.0f}",
+                    "peak_rss_mb": f"{peak_rss_mb():.0f}",
+                }
+            )
+    print_table(rows, list(rows[0]))
+    return rows
+
+
+def benchmark_storm(args):
+    """
+    Async requests through the real `ChatgptModel` against `mock_server.py`
+    with a quota far below the offered load, so most requests first get a
+    429 and the rate limiter and retries have to absorb the storm.
+    """
+    from data_handler import create_data_handler
+    from executor import agenerate_inference_data, create_model
+    from mock_server import serve
+
+    server = serve("127.0.0.1", 0, rpm=args.storm_rpm, tpm=10**9, latency=args.latency)
+    rows = args.rows if args.rows > 0 else 450
+    try:
+        with tempfile.TemporaryDirectory() as folder:
+            config_file_path = write_config(
+                folder,
+                args.emotion_data_path,
+                model="gpt-4o",
+                base_url=f"http://127.0.0.1:{server.server_address[1]}/v1",
+                # the configured quota is too optimistic, the server's 429s correct it
+                rate_limit={
+                    "requests_per_minute": 4 * args.storm_rpm,
+                    "tokens_per_minute": 10**9,
+                },
+                resilience={"max_retries": 8, "backoff_base": 0.1, "max_backoff": 5},
+            )
+            data_handler = create_data_handler(config_file_path)
+            model = create_model(data_handler, api_key="benchmark", token=None)
+
+            def run(metrics):
+                asyncio.run(
+                    agenerate_inference_data(
+                        data_handler,
+                        ChatGptMessageCreator(),
+                        model,
+                        total=rows,
+                        concurrency=max(args.concurrency, 16),
+                        metrics=metrics,
+                    )
+                )
+
+            row = run_generation("storm", run, rows)
+    finally:
+        server.shutdown()
+    row["rate_limited"] = server.state.stats["rate_limited"]
+    print_table([row], list(row))
+    return [row]
+
+
+def benchmark_local(args):
+    """Batched greedy generation of the `Llama3` path with a tiny random model on the CPU."""
+    from data_handler import create_data_handler
+    from executor import create_model, generate_batched_inference_data
+
+    rows = args.rows if args.rows > 0 else 64
+    model_path = args.tiny_model_path or os.path.join(tempfile.gettempdir(), "tiny-llama")
+    build_tiny_model(model_path, args.emotion_data_path)
+    with tempfile.TemporaryDirectory() as folder:
+        config_file_path = write_config(
+            folder,
+            args.emotion_data_path,
+            # the name has to contain "llama" to take the local path
+            model=model_path,
+            device="cpu",
+            load_in_4bit=False,
+            decoding={1: "greedy"},
+        )
+        data_handler = create_data_handler(config_file_path)
+        model = create_model(data_handler, api_key="", token=None)
+
+        def run(metrics):
+            generate_batched_inference_data(
+                data_handler,
+                ChatGptMessageCreator(),
+                model,
+                total=rows,
+                batch_size=args.generation_batch_size,
+                metrics=metrics,
+            )
+
+        row = run_generation("local", run, rows)
+    print_table([row], list(row))
+    return [row]
+
+
+suite_scenarios = ["data_handler", "pipeline", "resume", "storm", "local"]
+
+
+def run_scenario(name, args):
+    logging.basicConfig(level=logging.ERROR)
+    return scenarios[name](args)
+
+
+def benchmark_suite(args):
+    """Every pipeline scenario in a fresh process, so that startup time and peak RSS aren't shared."""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    rows = []
+    for name in suite_scenarios:
+        with ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            rows.extend(executor.submit(run_scenario, name, args).result())
+    return rows
+
+
+scenarios = {
+    "decoding": benchmark_decoding,
+    "pipeline": benchmark_pipeline,
+    "resume": benchmark_resume,
+    "data_handler": benchmark_data_handler,
+    "storm": benchmark_storm,
+    "local": benchmark_local,
+    "suite": benchmark_suite,
+}
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("scenario", choices=sorted(scenarios))
+    parser.add_argument("--emotion_data_path", type=str, default="../Data/processed_dataset.csv")
+    parser.add_argument("--prompt_version", type=int, default=1)
+    parser.add_argument("--prompts", type=int, default=32)
+    parser.add_argument("--model_path", type=str, default="meta-llama/Meta-Llama-3-8B-Instruct")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--token", type=str, default=None)
+    parser.add_argument("--load_in_4bit", action="store_true")
+    parser.add_argument(
+        "--modes", nargs="+", default=["beam", "greedy", "constrained", "score"]
+    )
+    parser.add_argument(
+        "--rows", type=int, default=-1, help="data points per run, -1 for the whole dataset"
+    )
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.001, help="mean mock latency in seconds")
+    parser.add_argument(
+        "--latency_distribution",
+        choices=["constant", "exponential", "lognormal"],
+        default="lognormal",
+    )
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--storm_rpm", type=int, default=600)
+    parser.add_argument("--tiny_model_path", type=str, default=None)
+    parser.add_argument("--generation_batch_size", type=int, default=8)
+    parser.add_argument("--output", type=str, default=None, help="save the result rows as JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING)
+    rows = scenarios[args.scenario](args)
+    if args.scenario == "suite":
+        columns = []
+        for row in rows:
+            columns.extend(column for column in row if column not in columns)
+        print_table(rows, columns)
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2, ensure_ascii=False)
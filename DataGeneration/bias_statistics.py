@@ -0,0 +1,286 @@
+"""
+Significance tests of the emotion differences between the personas.
+
+The tests run per (model, prompt version) on the paired responses of the
+emotion shift matrices (see `emotion_shift.py`), collapsed to the `k` most
+frequent emotions and an "other" category:
+
+- chi-square test of independence of persona and emotion,
+- Stuart-Maxwell test of marginal homogeneity of the paired table, and an
+  exact McNemar test per emotion,
+- bootstrap confidence intervals of the man - woman count difference per
+  emotion, resampling the IDs,
+- permutation test of swapping the persona labels within each ID, per
+  emotion and adjusted over the emotions by the maximum statistic.
+
+A resample only depends on the cells of the collapsed table, so the
+bootstrap draws multinomial cell counts and the permutation test binomial
+swap counts, thousands at once as arrays:
+
+    $ python bias_statistics.py --store ../Data/results.sqlite --substitutions ../Data/substitutions.jsonl \
+        --resamples 10000 --output ../Data/bias_statistics.csv --summary_output ../Data/bias_tests.csv
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from emotion_shift import EmotionShift
+
+logger = logging.getLogger(__name__)
+
+# cells of the resampled tables held in memory at once
+max_resample_cells = 4_000_000
+
+
+def collapse(matrix, emotion_ids):
+    """
+    (k + 1) x (k + 1) table of a man x woman matrix over the emotions with
+    the given ids, every other emotion counted in the last row and column.
+    """
+    k = len(emotion_ids)
+    mapping = np.full(matrix.shape[0], k, dtype=np.int64)
+    mapping[np.asarray(emotion_ids, dtype=np.int64)] = np.arange(k)
+    coo = matrix.tocoo()
+    cells = mapping[coo.row] * (k + 1) + mapping[coo.col]
+    return np.bincount(cells, weights=coo.data, minlength=(k + 1) ** 2).astype(np.int64).reshape(k + 1, k + 1)
+
+
+def chi_square(table):
+    """Chi-square test of independence on the persona x emotion counts."""
+    counts = np.vstack([table.sum(axis=1), table.sum(axis=0)])
+    counts = counts[:, counts.sum(axis=0) > 0]
+    if counts.shape[1] < 2:
+        return np.nan, np.nan
+    statistic, p_value, _, _ = stats.chi2_contingency(counts, correction=False)
+    return statistic, p_value
+
+
+def stuart_maxwell(table):
+    """Stuart-Maxwell test that the man and woman marginals of a paired table are equal."""
+    difference = table.sum(axis=1) - table.sum(axis=0)
+    covariance = -(table + table.T).astype(float)
+    np.fill_diagonal(covariance, table.sum(axis=1) + table.sum(axis=0) - 2 * np.diag(table))
+    # one category is redundant; empty categories leave the covariance singular
+    difference, covariance = difference[:-1], covariance[:-1, :-1]
+    degrees_of_freedom = np.linalg.matrix_rank(covariance)
+    if degrees_of_freedom == 0:
+        return np.nan, np.nan
+    statistic = float(difference @ np.linalg.pinv(covariance) @ difference)
+    return statistic, stats.chi2.sf(statistic, degrees_of_freedom)
+
+
+def mcnemar(table):
+    """
+    Exact McNemar test per category: `b` IDs got the emotion for the man
+    only, `c` for the woman only.
+    """
+    diagonal = np.diag(table)
+    b = table.sum(axis=1) - diagonal
+    c = table.sum(axis=0) - diagonal
+    p_values = np.minimum(1.0, 2 * stats.binom.cdf(np.minimum(b, c), b + c, 0.5))
+    return b, c, p_values
+
+
+def chunks(resamples, cells):
+    size = max(1, max_resample_cells // max(cells, 1))
+    for start in range(0, resamples, size):
+        yield min(size, resamples - start)
+
+
+def bootstrap_differences(table, resamples, rng):
+    """Man - woman count differences per category of `resamples` bootstrap samples of the IDs."""
+    total = table.sum()
+    probabilities = table.ravel() / total
+    size = table.shape[0]
+    differences = []
+    for chunk in chunks(resamples, table.size):
+        samples = rng.multinomial(total, probabilities, size=chunk).reshape(chunk, size, size)
+        differences.append(samples.sum(axis=2) - samples.sum(axis=1))
+    return np.concatenate(differences)
+
+
+def permutation_differences(table, resamples, rng):
+    """
+    Man - woman count differences per category when the persona labels of
+    every ID are swapped with probability 1/2: of the `n` IDs answered
+    (i, j) or (j, i), a binomial number ends up as (i, j).
+    """
+    size = table.shape[0]
+    rows, columns = np.triu_indices(size, k=1)
+    discordant = table[rows, columns] + table[columns, rows]
+    keep = discordant > 0
+    rows, columns, discordant = rows[keep], columns[keep], discordant[keep]
+    # +1 for the man's emotion of a pair, -1 for the woman's
+    signs = np.zeros((len(discordant), size), dtype=np.int64)
+    signs[np.arange(len(discordant)), rows] = 1
+    signs[np.arange(len(discordant)), columns] = -1
+    differences = []
+    for chunk in chunks(resamples, max(len(discordant), 1)):
+        swapped = rng.binomial(discordant, 0.5, size=(chunk, len(discordant)))
+        differences.append((2 * swapped - discordant) @ signs)
+    return np.concatenate(differences)
+
+
+def analyse_table(table, emotions, resamples=10000, confidence=0.95, seed=None):
+    """
+    Every test on one collapsed table whose first `len(emotions)` categories
+    are `emotions`. Returns the run's tests and a frame with a row per emotion.
+    """
+    rng = np.random.default_rng(seed)
+    k = len(emotions)
+    man_counts = table.sum(axis=1)
+    woman_counts = table.sum(axis=0)
+    observed = man_counts - woman_counts
+    chi2_statistic, chi2_p_value = chi_square(table)
+    stuart_maxwell_statistic, stuart_maxwell_p_value = stuart_maxwell(table)
+    b, c, mcnemar_p_values = mcnemar(table)
+
+    alpha = 1 - confidence
+    bootstrap = bootstrap_differences(table, resamples, rng)
+    low, high = np.quantile(bootstrap[:, :k], [alpha / 2, 1 - alpha / 2], axis=0)
+
+    permuted = np.abs(permutation_differences(table, resamples, rng)[:, :k])
+    extreme = np.abs(observed[:k])
+    permutation_p_values = (1 + (permuted >= extreme).sum(axis=0)) / (resamples + 1)
+    maximum = permuted.max(axis=1, initial=0)
+    adjusted_p_values = (1 + (maximum[:, None] >= extreme).sum(axis=0)) / (resamples + 1)
+
+    summary = {
+        "pairs": int(table.sum()),
+        "chi2": chi2_statistic,
+        "chi2_p": chi2_p_value,
+        "stuart_maxwell": stuart_maxwell_statistic,
+        "stuart_maxwell_p": stuart_maxwell_p_value,
+        "permutation_p": adjusted_p_values.min() if k else np.nan,
+    }
+    per_emotion = pd.DataFrame(
+        {
+            "emotion": list(emotions),
+            "man_count": man_counts[:k],
+            "woman_count": woman_counts[:k],
+            "difference": observed[:k],
+            "ci_low": low,
+            "ci_high": high,
+            "man_only": b[:k],
+            "woman_only": c[:k],
+            "mcnemar_p": mcnemar_p_values[:k],
+            "permutation_p": permutation_p_values,
+            "permutation_p_adjusted": adjusted_p_values,
+        }
+    )
+    return summary, per_emotion
+
+
+def run_tests(
+    shift: EmotionShift,
+    k=8,
+    emotions=None,
+    resamples=10000,
+    confidence=0.95,
+    seed=0,
+    processes=1,
+):
+    """
+    Test every (model, prompt version) of `shift` on its `k` most frequent
+    emotions, or on `emotions`. With `processes` > 1 the runs are tested in
+    parallel; the results don't depend on it. Returns the per-run tests and
+    the per-emotion results.
+    """
+    if emotions is not None:
+        missing = [emotion for emotion in emotions if emotion not in shift.codes]
+        if missing:
+            logger.warning(f"No responses for {', '.join(missing)}")
+        emotions = [emotion for emotion in emotions if emotion in shift.codes]
+    runs = shift.runs()
+    tables = []
+    for model, prompt_version in runs:
+        matrix = shift.matrix(model, prompt_version)
+        if emotions is None:
+            totals = np.asarray(matrix.sum(axis=1)).ravel() + np.asarray(matrix.sum(axis=0)).ravel()
+            emotion_ids = np.argsort(-totals, kind="stable")[: min(k, np.count_nonzero(totals))]
+        else:
+            emotion_ids = np.array([shift.codes[emotion] for emotion in emotions], dtype=np.int64)
+        tables.append((collapse(matrix, emotion_ids), list(shift.vocabulary[emotion_ids])))
+
+    # a seed per run, so that the results are the same however the runs are spread
+    seeds = np.random.SeedSequence(seed).spawn(len(runs))
+    arguments = [
+        (table, run_emotions, resamples, confidence, run_seed)
+        for (table, run_emotions), run_seed in zip(tables, seeds)
+    ]
+    if processes > 1 and len(runs) > 1:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            results = list(executor.map(analyse_table, *zip(*arguments)))
+    else:
+        results = [analyse_table(*run_arguments) for run_arguments in arguments]
+
+    summaries = pd.DataFrame(
+        [
+            {"model": model, "prompt_version": prompt_version, **summary}
+            for (model, prompt_version), (summary, _) in zip(runs, results)
+        ]
+    )
+    frames = [
+        per_emotion.assign(model=model, prompt_version=prompt_version)
+        for (model, prompt_version), (_, per_emotion) in zip(runs, results)
+    ]
+    per_emotion = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if not per_emotion.empty:
+        columns = ["model", "prompt_version"]
+        per_emotion = per_emotion[columns + [column for column in per_emotion if column not in columns]]
+    return summaries, per_emotion
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, default=None)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--prompt_version", type=int, default=None)
+    parser.add_argument("--top_k", type=int, default=8)
+    parser.add_argument(
+        "--emotions", type=str, nargs="+", default=None, help="test these emotions instead of the top k"
+    )
+    parser.add_argument("--resamples", type=int, default=10000)
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--output", type=str, default=None, help="CSV of the per-emotion results")
+    parser.add_argument("--summary_output", type=str, default=None, help="CSV of the per-run tests")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from emotion_shift import create_emotion_shift
+    from result_store import ResultStore
+
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    results = ResultStore(args.store).to_dataframe(args.model, args.prompt_version)
+    summaries, per_emotion = run_tests(
+        create_emotion_shift(results, args.substitutions),
+        k=args.top_k,
+        emotions=args.emotions,
+        resamples=args.resamples,
+        confidence=args.confidence,
+        seed=args.seed,
+        processes=args.processes,
+    )
+    print(summaries.to_string(index=False))
+    print(per_emotion.to_string(index=False))
+    if args.summary_output is not None:
+        summaries.to_csv(args.summary_output, index=False)
+        print(f"Wrote {args.summary_output}")
+    if args.output is not None:
+        per_emotion.to_csv(args.output, index=False)
+        print(f"Wrote {args.output}")
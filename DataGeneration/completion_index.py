@@ -0,0 +1,155 @@
+"""
+Index of the (ID, persona, model, prompt_version) keys that already have a
+response in the storage folder.
+
+The index lives next to the responses as an append-only `manifest.jsonl`:
+it is read once into a set when a run starts and one line is appended for
+every saved response, so resuming never has to stat the per-ID folders. A
+rebuilt manifest starts with a header line recording the rebuild, so even an
+empty one isn't rebuilt again. If the manifest is missing or stale it can be
+rebuilt from the files:
+
+    $ python completion_index.py rebuild --storage_folder_path ../Data/Storage/ --prompt_version 2
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+manifest_filename = "manifest.jsonl"
+response_filename_pattern = re.compile(
+    r"^(?P<persona>[^_]+)_(?P<model>.+?)(?:_I(?P<prompt_version>\d+))?_response\.txt$"
+)
+
+
+def response_filename(persona, model, prompt_version):
+    return f"{persona}_{model}_I{prompt_version}_response.txt"
+
+
+def distribution_filename(persona, model, prompt_version):
+    return f"{persona}_{model}_I{prompt_version}_distribution.json"
+
+
+class CompletionIndex:
+    def __init__(self, storage_folder_path) -> None:
+        self.storage_folder_path = storage_folder_path
+        self.path = os.path.join(storage_folder_path, manifest_filename)
+        self.lock = threading.Lock()
+        self.keys = set()
+        # the header of a rebuilt manifest, e.g. {"rebuilt_at": ..., "unversioned": 3}
+        self.header = None
+        self.has_manifest = os.path.exists(self.path)
+        if self.has_manifest:
+            self.__load()
+
+    def __load(self):
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                    if isinstance(entry, dict):
+                        self.header = entry
+                        continue
+                    index, persona, model, prompt_version = entry
+                except ValueError:
+                    # a line cut short by a crash; the response is re-generated
+                    continue
+                self.keys.add((str(index), persona, model, int(prompt_version)))
+        logger.info(f"Loaded {len(self.keys)} completed responses from {self.path}")
+
+    @staticmethod
+    def make_key(index, persona, model, prompt_version):
+        return (str(index), persona, model, int(prompt_version))
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key):
+        with self.lock:
+            if key in self.keys:
+                return
+            self.keys.add(key)
+            if not os.path.exists(self.storage_folder_path):
+                os.makedirs(self.storage_folder_path)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(list(key), ensure_ascii=False) + "\n")
+
+    def rebuild(self, legacy_prompt_version=None):
+        """
+        Recreate the manifest from the response files in the storage folder.
+        Files written before the prompt version was part of the file name are
+        attributed to `legacy_prompt_version` (skipped if it is None).
+        """
+        keys = set()
+        unversioned = 0
+        if os.path.exists(self.storage_folder_path):
+            for folder in os.scandir(self.storage_folder_path):
+                if not folder.is_dir():
+                    continue
+                for file in os.scandir(folder.path):
+                    match = response_filename_pattern.match(file.name)
+                    if match is None:
+                        continue
+                    prompt_version = match.group("prompt_version")
+                    if prompt_version is None:
+                        if legacy_prompt_version is None:
+                            unversioned += 1
+                            continue
+                        prompt_version = legacy_prompt_version
+                    keys.add(
+                        self.make_key(
+                            folder.name,
+                            match.group("persona"),
+                            match.group("model"),
+                            prompt_version,
+                        )
+                    )
+
+        with self.lock:
+            self.keys = keys
+            temporary_path = f"{self.path}.tmp"
+            self.header = {"rebuilt_at": time.time(), "unversioned": unversioned}
+            with open(temporary_path, "w", encoding="utf-8") as file:
+                file.write(json.dumps(self.header) + "\n")
+                for key in sorted(keys):
+                    file.write(json.dumps(list(key), ensure_ascii=False) + "\n")
+            os.replace(temporary_path, self.path)
+            self.has_manifest = True
+        logger.info(f"Rebuilt {self.path} with {len(keys)} completed responses")
+        if unversioned:
+            logger.warning(
+                f"Skipped {unversioned} response files without a prompt version in their name; "
+                f"run `python completion_index.py rebuild --storage_folder_path {self.storage_folder_path} "
+                f"--prompt_version N` to count them as prompt version N"
+            )
+        return len(keys)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--storage_folder_path", type=str, required=True)
+    parser.add_argument(
+        "--prompt_version",
+        type=int,
+        default=None,
+        help="prompt version of response files that don't name one",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    index = CompletionIndex(args.storage_folder_path)
+    print(f"Indexed {index.rebuild(args.prompt_version)} responses")
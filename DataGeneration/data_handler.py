@@ -1,14 +1,26 @@
 from abc import ABC, abstractmethod
+import itertools
 import yaml
+import json
 import logging
 import pandas as pd
 import os
+import zlib
+from completion_index import CompletionIndex, distribution_filename, response_filename
+from resilience import DeadLetterQueue
+from result_store import ResultStore
+from tracing import traced_iterator, tracer
 
 logger = logging.getLogger(__name__)
 
 persona = ["man", "woman"]
 
 
+def shard_of(index, shard_count):
+    # crc32 rather than hash() so that every process agrees on the shard
+    return zlib.crc32(str(index).encode("utf-8")) % shard_count
+
+
 def sanitize_model_name(model_name: str):
     model_name = model_name.split("/")[0]
     model_name = model_name.replace(".", "_").replace("-", "_")
@@ -32,11 +44,58 @@ class DataHandlerBase(ABC):
     def save_generated_data(self, content, persona, index, filepath=None):
         pass
 
+    def save_model_response(self, model_response, persona, index):
+        with tracer.span("save"):
+            self.__save_model_response(model_response, persona, index)
+
+    def __save_model_response(self, model_response, persona, index):
+        self.save_generated_data(model_response["content"], persona=persona, index=index)
+        # scoring modes also return the probability of every candidate answer
+        if "distribution" in model_response:
+            model_name = sanitize_model_name(self.get_model_name())
+            self.save_generated_data(
+                json.dumps(model_response["distribution"], ensure_ascii=False),
+                persona=persona,
+                index=index,
+                filepath=os.path.join(
+                    str(index),
+                    distribution_filename(persona, model_name, self.get_prompt_version()),
+                ),
+            )
+
+    def save_failed_request(self, model_message, persona, index, error):
+        logger.error(f"Error in creating response for index {index} and persona {persona}")
+        logger.error(error)
+
 
 class DataHandler(DataHandlerBase):
-    def __init__(self, config_file_path):
+    def __init__(self, config_file_path, overrides=None):
         self.config_file_path = config_file_path
         self.__read_config_file()
+        # e.g. the model and prompt version of one job of a sweep
+        self.config.update(overrides or {})
+        self.personas = self.config.get("personas", persona)
+        self.model_name = sanitize_model_name(self.config["model"])
+        self.completed = None
+        self.shard = None
+        self.work_queue = None
+        self.worker_id = None
+        self.saved_personas = {}
+        self.dead_letters = DeadLetterQueue(
+            self.config.get(
+                "dead_letter_path",
+                os.path.join(self.config["storage_folder_path"], "dead_letters.jsonl"),
+            )
+        )
+
+    def set_shard(self, shard_index, shard_count):
+        """Only handle the data points whose ID hashes to `shard_index` out of `shard_count`."""
+        self.shard = (shard_index, shard_count)
+
+    def set_work_queue(self, work_queue, worker_id):
+        """Lease every data point from a shared `WorkQueue` before handing it out."""
+        self.work_queue = work_queue
+        self.worker_id = worker_id
 
     def __read_config_file(self):
         with open(self.config_file_path, "r") as f:
@@ -50,60 +109,136 @@ class DataHandler(DataHandlerBase):
             logger.error(f"Error occurred while reading file: {e}\n")
             pass
 
-    def __read_emotion_data(self):
-        emotion_df = pd.read_csv(self.config["emotion_data_path"])
-        print(f"Selected data points length: {len(emotion_df)}")
-        return emotion_df
+    def read_emotion_data(self):
+        # read lazily in chunks so that memory stays flat for large datasets
+        return pd.read_csv(
+            self.config["emotion_data_path"],
+            chunksize=self.config.get("read_chunk_size", 10000),
+        )
+
+    def _load_completed(self):
+        completed = CompletionIndex(self.config["storage_folder_path"])
+        if not completed.has_manifest and os.path.exists(self.config["storage_folder_path"]):
+            # storage written before the manifest existed; files that don't name
+            # their prompt version are left out, as they may be of another version
+            completed.rebuild()
+        return completed
 
-    def __is_datapoint_eligible(self, index, reject_for_one_response=True):
+    def _is_datapoint_eligible(self, index, reject_for_one_response=True):
+        if self.shard is not None and shard_of(index, self.shard[1]) != self.shard[0]:
+            return False
         # skip if the response already exists
-        model_name = sanitize_model_name(self.config["model"])
-        for per in persona:
-            response_file_path = os.path.join(
-                self.config["storage_folder_path"],
-                str(index),
-                f"{per}_{model_name}_response.txt",
+        for per in self.personas:
+            key = CompletionIndex.make_key(
+                index, per, self.model_name, self.get_prompt_version()
             )
-            if reject_for_one_response and os.path.exists(response_file_path):
+            if reject_for_one_response and key in self.completed:
                 logger.info(f"Response already exist for index: {index}")
                 return False
 
         return True
 
-    def __create_valid_data_points(self):
-        emotion_df = self.__read_emotion_data()
-        emotion_df_valid_mask = emotion_df["ID"].apply(
-            lambda x: self.__is_datapoint_eligible(x)
-        )
-        emotion_df_valid = emotion_df[emotion_df_valid_mask]
-        return emotion_df_valid.to_dict(orient="records")
+    def filter_data_points(self, emotion_df, indices=None):
+        """Records of `emotion_df` that still need a response (limited to `indices` if given)."""
+        if self.completed is None:
+            with tracer.span("load_completed"):
+                self.completed = self._load_completed()
+        with tracer.span("eligibility", rows=len(emotion_df)):
+            emotion_df_valid_mask = [
+                (indices is None or str(index) in indices)
+                and self._is_datapoint_eligible(index)
+                for index in emotion_df["ID"]
+            ]
+            emotion_df_valid = emotion_df[emotion_df_valid_mask]
+            return emotion_df_valid.to_dict(orient="records")
+
+    def __create_valid_data_points(self, indices=None):
+        with self.read_emotion_data() as emotion_chunks:
+            for emotion_df in traced_iterator("read_csv", emotion_chunks):
+                yield from self.filter_data_points(emotion_df, indices)
 
     def get_model_name(self):
         return self.config["model"]
 
+    def get_config_value(self, key, default=None):
+        return self.config.get(key, default)
+
     def get_personas(self):
-        return persona
+        return self.personas
 
     def get_prompt_version(self):
         return self.config["prompt_version"]
 
+    def __claim_data_points(self, valid_data_points):
+        for data_point in valid_data_points:
+            if self.work_queue is None or self.work_queue.claim(
+                data_point["ID"],
+                self.model_name,
+                self.get_prompt_version(),
+                self.worker_id,
+            ):
+                yield data_point
+
+    def __reclaim_expired_data_points(self):
+        # data points left behind by crashed workers, picked up after the lease ran out
+        while True:
+            expired = self.work_queue.expired(self.model_name, self.get_prompt_version())
+            reclaimed = 0
+            if expired:
+                for data_point in self.__claim_data_points(
+                    self.__create_valid_data_points(expired)
+                ):
+                    reclaimed += 1
+                    yield data_point
+            if reclaimed == 0:
+                break
+
     def return_data_point(self, total=-1):
-        valid_data_points = self.__create_valid_data_points()
+        valid_data_points = self.__claim_data_points(self.__create_valid_data_points())
+        if self.work_queue is not None:
+            valid_data_points = itertools.chain(
+                valid_data_points, self.__reclaim_expired_data_points()
+            )
 
         for i, data_point in enumerate(valid_data_points):
             yield data_point
             if i == total - 1:
                 break
 
+    def save_failed_request(self, model_message, persona, index, error):
+        super().save_failed_request(model_message, persona, index, error)
+        self.dead_letters.add(
+            index, persona, self.model_name, self.get_prompt_version(), model_message, error
+        )
+
+    def _mark_saved(self, index, persona):
+        if self.work_queue is None:
+            return
+        saved = self.saved_personas.setdefault(str(index), set())
+        saved.add(persona)
+        if len(saved) < len(self.get_personas()):
+            self.work_queue.renew(
+                index, self.model_name, self.get_prompt_version(), self.worker_id
+            )
+            return
+        del self.saved_personas[str(index)]
+        self.work_queue.complete(
+            index, self.model_name, self.get_prompt_version(), self.worker_id
+        )
+
     def save_generated_data(self, content, persona, index, filepath=None):
+        key = None
         if filepath is None:
-            filename = (
-                f"{persona}_{sanitize_model_name(self.config['model'])}_response.txt"
+            filename = response_filename(
+                persona, self.model_name, self.get_prompt_version()
             )
             folder_path = os.path.join(self.config["storage_folder_path"], str(index))
             if not os.path.exists(folder_path):
                 os.makedirs(folder_path)
             filepath = os.path.join(folder_path, filename)
+            key = CompletionIndex.make_key(
+                index, persona, self.model_name, self.get_prompt_version()
+            )
         else:
             filepath = os.path.join(self.config["storage_folder_path"], filepath)
 
@@ -113,7 +248,65 @@ class DataHandler(DataHandlerBase):
                 logger.info(f"Content saved to file: {filepath}\n")
         except Exception as e:
             logger.error(f"Error occurred while writing to file: {e}\n")
-            pass  # Skip the operation if an error occurs
+            return  # Skip the operation if an error occurs
+
+        if key is not None:
+            if self.completed is None:
+                self.completed = self._load_completed()
+            self.completed.add(key)
+            self._mark_saved(index, persona)
+
+
+class ResultStoreDataHandler(DataHandler):
+    """
+    Keeps the responses in a `ResultStore` (config key `result_store_path`)
+    instead of one text file per response.
+    """
+
+    def __init__(self, config_file_path, overrides=None):
+        super().__init__(config_file_path, overrides)
+        self.store = ResultStore(self.config["result_store_path"])
+
+    def _load_completed(self):
+        return self.store.keys(self.model_name, self.get_prompt_version())
+
+    def save_model_response(self, model_response, persona, index):
+        with tracer.span("save"):
+            self.__save_model_response(model_response, persona, index)
+
+    def __save_model_response(self, model_response, persona, index):
+        self.store.add(
+            index,
+            persona,
+            self.model_name,
+            self.get_prompt_version(),
+            model_response["content"],
+            distribution=model_response.get("distribution"),
+            input_tokens=model_response.get("input_tokens"),
+            output_tokens=model_response.get("output_tokens"),
+        )
+        if self.completed is None:
+            self.completed = self._load_completed()
+        self.completed.add(
+            CompletionIndex.make_key(
+                index, persona, self.model_name, self.get_prompt_version()
+            )
+        )
+        self._mark_saved(index, persona)
+
+    def save_generated_data(self, content, persona, index, filepath=None):
+        if filepath is not None:
+            return super().save_generated_data(content, persona, index, filepath)
+        self.save_model_response({"content": content}, persona=persona, index=index)
+
+
+def create_data_handler(config_file_path, overrides=None) -> DataHandler:
+    with open(config_file_path, "r") as f:
+        config = yaml.safe_load(f)
+    config.update(overrides or {})
+    if config.get("result_store_path"):
+        return ResultStoreDataHandler(config_file_path, overrides)
+    return DataHandler(config_file_path, overrides)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+"""
+Emotion shift between the personas.
+
+For every (model, prompt version) the normalised responses of the two
+personas to the same ID are paired and counted in a sparse man × woman
+contingency matrix: entry (i, j) is the number of IDs answered with emotion
+i for the man and emotion j for the woman. All responses are integer coded
+once with `pd.factorize` and the pairs of each run are summed by
+`scipy.sparse`, so building the matrices is a single pass however large the
+vocabulary is. A row answers "what does the woman get when the man gets
+emotion i", a column the other direction. The file `GraphGeneration/horizontal_bar.py`
+plots is written from them:
+
+    $ python emotion_shift.py --store ../Data/results.sqlite --substitutions ../Data/substitutions.jsonl \
+        --model gpt-3.5-turbo --prompt_version 1 --output ../GraphGeneration/emotion_shift_latest.csv
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from postprocess import ResponseNormalizer, load_substitutions, normalize_results
+
+logger = logging.getLogger(__name__)
+
+personas = ("man", "woman")
+
+
+class EmotionShift:
+    def __init__(self, vocabulary, matrices) -> None:
+        self.vocabulary = np.asarray(vocabulary, dtype=object)
+        self.codes = {emotion: code for code, emotion in enumerate(self.vocabulary)}
+        # {(model, prompt_version): CSR matrix with the man's emotions as rows}
+        self.matrices = matrices
+        self.transposed = {}
+
+    @classmethod
+    def from_results(cls, results: pd.DataFrame, column="response"):
+        """
+        Build the matrices from a long frame with `id`, `persona`, `model`,
+        `prompt_version` and the normalised `column`. Empty responses are left out.
+        """
+        results = results[results["persona"].isin(personas) & results[column].fillna("").ne("")]
+        codes, vocabulary = pd.factorize(results[column])
+        runs = results.groupby(["model", "prompt_version"], sort=True).ngroup().to_numpy()
+        ids = pd.factorize(results["id"])[0]
+        # one integer per (run, id) to pair the personas on
+        frame = pd.DataFrame(
+            {
+                "key": runs.astype(np.int64) * (ids.max() + 1 if len(ids) else 1) + ids,
+                "run": runs,
+                "code": codes,
+            }
+        )
+        is_man = (results["persona"] == personas[0]).to_numpy()
+        pairs = (
+            frame[is_man]
+            .drop_duplicates("key", keep="last")
+            .merge(
+                frame[~is_man].drop_duplicates("key", keep="last"),
+                on=["key", "run"],
+                suffixes=("_man", "_woman"),
+            )
+        )
+
+        run_keys = (
+            results[["model", "prompt_version"]]
+            .assign(run=runs)
+            .drop_duplicates("run")
+            .set_index("run")
+        )
+        size = len(vocabulary)
+        matrices = {}
+        for run, positions in pairs.groupby("run").indices.items():
+            run_pairs = pairs.iloc[positions]
+            # duplicate (i, j) entries are summed on conversion
+            matrix = sparse.coo_matrix(
+                (
+                    np.ones(len(run_pairs), dtype=np.int64),
+                    (run_pairs["code_man"].to_numpy(), run_pairs["code_woman"].to_numpy()),
+                ),
+                shape=(size, size),
+            ).tocsr()
+            model, prompt_version = run_keys.loc[run]
+            matrices[(model, int(prompt_version))] = matrix
+        logger.info(
+            f"Paired {len(pairs)} responses over {len(matrices)} runs and {size} emotions"
+        )
+        return cls(vocabulary, matrices)
+
+    def runs(self):
+        return sorted(self.matrices)
+
+    def matrix(self, model=None, prompt_version=None):
+        """The matrix of one run, or the sum over every model and/or prompt version left out."""
+        matrices = [
+            matrix
+            for (run_model, run_version), matrix in self.matrices.items()
+            if (model is None or run_model == model)
+            and (prompt_version is None or run_version == int(prompt_version))
+        ]
+        if not matrices:
+            raise KeyError(f"No responses of {model} for prompt version {prompt_version}")
+        if len(matrices) == 1:
+            return matrices[0]
+        return sum(matrices[1:], matrices[0]).tocsr()
+
+    def __oriented(self, persona, model, prompt_version):
+        """The matrix with `persona`'s emotions as rows."""
+        if persona not in personas:
+            raise ValueError(f"Unknown persona: {persona}")
+        if persona == personas[0]:
+            return self.matrix(model, prompt_version)
+        key = (model, prompt_version)
+        if key not in self.transposed:
+            self.transposed[key] = self.matrix(model, prompt_version).T.tocsr()
+        return self.transposed[key]
+
+    def counts(self, persona="man", model=None, prompt_version=None) -> pd.Series:
+        """Paired responses per emotion of `persona`, most frequent first."""
+        totals = np.asarray(self.__oriented(persona, model, prompt_version).sum(axis=1)).ravel()
+        order = np.flatnonzero(totals)
+        order = order[np.argsort(-totals[order], kind="stable")]
+        return pd.Series(totals[order], index=self.vocabulary[order], name="count")
+
+    def top(self, emotion, persona="man", k=7, model=None, prompt_version=None, exclude_same=False):
+        """
+        The `k` most frequent emotions of the other persona for the IDs
+        where `persona` got `emotion`, most frequent first.
+        """
+        code = self.codes.get(emotion)
+        if code is None:
+            return pd.Series([], dtype=np.int64, name="count")
+        matrix = self.__oriented(persona, model, prompt_version)
+        start, end = matrix.indptr[code], matrix.indptr[code + 1]
+        indices = matrix.indices[start:end]
+        data = matrix.data[start:end]
+        if exclude_same:
+            keep = indices != code
+            indices, data = indices[keep], data[keep]
+        if len(data) > k:
+            # only the top k need sorting
+            selected = np.argpartition(-data, k - 1)[:k]
+            indices, data = indices[selected], data[selected]
+        order = np.lexsort((indices, -data))
+        return pd.Series(data[order], index=self.vocabulary[indices[order]], name="count")
+
+    def shifts(
+        self,
+        persona="man",
+        emotions=None,
+        n=3,
+        k=3,
+        model=None,
+        prompt_version=None,
+        exclude_same=True,
+    ) -> pd.DataFrame:
+        """
+        Top-k shifts of `emotions` (by default the `n` most frequent emotions
+        of `persona`) in the layout `horizontal_bar.py` reads.
+        """
+        if emotions is None:
+            emotions = self.counts(persona, model, prompt_version).index[:n]
+        rows = []
+        for emotion in emotions:
+            top = self.top(emotion, persona, k, model, prompt_version, exclude_same)
+            rows.extend(
+                {"persona": persona, "emotion": emotion, "shifted_emotion": shifted, "count": int(count)}
+                for shifted, count in top.items()
+            )
+        return pd.DataFrame(rows, columns=["persona", "emotion", "shifted_emotion", "count"])
+
+
+def create_emotion_shift(results: pd.DataFrame, substitutions_path=None):
+    substitutions = load_substitutions(substitutions_path) if substitutions_path else {}
+    results = normalize_results(results, ResponseNormalizer(substitutions))
+    return EmotionShift.from_results(results)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, default=None)
+    parser.add_argument("--model", type=str, default=None, help="sum over every model if not given")
+    parser.add_argument("--prompt_version", type=int, default=None)
+    parser.add_argument("--output", type=str, default=None)
+    parser.add_argument(
+        "--emotions_per_persona",
+        type=int,
+        default=3,
+        help="the most frequent emotions of each persona to show the shifts of",
+    )
+    parser.add_argument("--man_emotions", type=str, nargs="+", default=None)
+    parser.add_argument("--woman_emotions", type=str, nargs="+", default=None)
+    parser.add_argument("--top_k", type=int, default=3)
+    parser.add_argument(
+        "--include_same",
+        action="store_true",
+        help="count the IDs where both personas got the same emotion as a shift too",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from result_store import ResultStore
+
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    results = ResultStore(args.store).to_dataframe(args.model, args.prompt_version)
+    shift = create_emotion_shift(results, args.substitutions)
+    selected = {"man": args.man_emotions, "woman": args.woman_emotions}
+    table = pd.concat(
+        [
+            shift.shifts(
+                persona,
+                emotions=selected[persona],
+                n=args.emotions_per_persona,
+                k=args.top_k,
+                model=args.model,
+                prompt_version=args.prompt_version,
+                exclude_same=not args.include_same,
+            )
+            for persona in personas
+        ],
+        ignore_index=True,
+    )
+    print(table.to_string(index=False))
+    if args.output is not None:
+        table.to_csv(args.output, index=False)
+        print(f"Wrote {args.output}")
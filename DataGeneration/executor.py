@@ -1,8 +1,17 @@
 from data_handler import *
 from prompt_creator import *
 from models import *
+from rate_limiter import get_rate_limiter
+from response_cache import ResponseCache
+from batch_runner import OpenAIBatchClient, batch_discount, generate_batch_inference_data
+from resilience import ResilientModel, model_circuit_breaker, replay_dead_letters
+from work_queue import WorkQueue, default_worker_id, parse_shard
+from metrics import MetricsExporter, UsageMetrics, preflight, print_summary
+from tracing import tracer
 
 # from Llama3 import *
+import asyncio
+import time
 from datetime import datetime
 from tqdm import tqdm
 
@@ -16,6 +25,7 @@ def generate_inference_data(
     model: Model,
     total: int = -1,
     calcualate_cost: bool = False,
+    metrics: UsageMetrics = None,
 ):
     datapoints = data_handler.return_data_point(total)
     personas = data_handler.get_personas()
@@ -27,28 +37,126 @@ def generate_inference_data(
         logger.info(f"Current index: {current_index}")
         for persona in personas:
             logger.info(f"Current persona: {persona}")
-            prompt = prompt_creator.create_prompt(
-                prompt=data_point["text"],
-                persona=persona,
-                domain=data_point["Domain"],
-                version=prompt_version,
-            )
+            with tracer.span("render_prompt"):
+                prompt = prompt_creator.create_prompt(
+                    prompt=data_point["text"],
+                    persona=persona,
+                    domain=data_point["Domain"],
+                    version=prompt_version,
+                )
+            started = time.perf_counter()
             try:
-                model_response = model.create_response(prompt)
+                with tracer.span("request", index=str(current_index), persona=persona):
+                    model_response = model.create_response(prompt)
             except Exception as e:
-                logger.error(
-                    f"Error in creating response for index {current_index} and persona {persona}"
+                if metrics is not None:
+                    metrics.record_error(
+                        model, prompt_version, persona, time.perf_counter() - started
+                    )
+                data_handler.save_failed_request(
+                    prompt, persona=persona, index=current_index, error=e
                 )
-                logger.error(e)
                 continue
+            if metrics is not None:
+                metrics.record(
+                    model,
+                    prompt_version,
+                    persona,
+                    time.perf_counter() - started,
+                    model_response,
+                )
             # model_response = model.create_response(prompt)
-            response = model_response["content"]
+            data_handler.save_model_response(
+                model_response, persona=persona, index=current_index
+            )
 
-            data_handler.save_generated_data(
-                response, persona=persona, index=current_index
+            if calcualate_cost and not model_response.get("cached"):
+                total_input_tokens += model_response["input_tokens"]
+                total_output_tokens += model_response["output_tokens"]
+                cost = model.calculate_cost(
+                    model_response["input_tokens"], model_response["output_tokens"]
+                )
+                cost_till_now = model.calculate_cost(
+                    total_input_tokens, total_output_tokens
+                )
+                logger.info(
+                    f"Cost for index {current_index}: {cost}, Total cost: {cost_till_now}"
+                )
+
+
+def generate_batched_inference_data(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    model: Model,
+    total: int = -1,
+    calcualate_cost: bool = False,
+    batch_size: int = 8,
+    metrics: UsageMetrics = None,
+):
+    """
+    Variant of `generate_inference_data` for models that answer several prompts
+    in one call (`Model.create_batch_response`): pending (data point, persona)
+    pairs are grouped into batches of `batch_size` prompts.
+    """
+    personas = data_handler.get_personas()
+    prompt_version = data_handler.get_prompt_version()
+    total_input_tokens = 0
+    total_output_tokens = 0
+
+    def batches():
+        batch = []
+        for data_point in data_handler.return_data_point(total):
+            for persona in personas:
+                batch.append((data_point, persona))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    for batch in tqdm(batches()):
+        with tracer.span("render_prompt", prompts=len(batch)):
+            prompts = [
+                prompt_creator.create_prompt(
+                    prompt=data_point["text"],
+                    persona=persona,
+                    domain=data_point["Domain"],
+                    version=prompt_version,
+                )
+                for data_point, persona in batch
+            ]
+        started = time.perf_counter()
+        try:
+            with tracer.span("request", prompts=len(batch)):
+                model_responses = model.create_batch_response(prompts)
+        except Exception as e:
+            latency = time.perf_counter() - started
+            for (data_point, persona), prompt in zip(batch, prompts):
+                if metrics is not None:
+                    metrics.record_error(model, prompt_version, persona, latency)
+                data_handler.save_failed_request(
+                    prompt, persona=persona, index=data_point["ID"], error=e
+                )
+            continue
+        # every prompt of a batch waits for the whole batch
+        latency = time.perf_counter() - started
+
+        for (data_point, persona), prompt, model_response in zip(batch, prompts, model_responses):
+            current_index = data_point["ID"]
+            if isinstance(model_response, Exception):
+                if metrics is not None:
+                    metrics.record_error(model, prompt_version, persona, latency)
+                data_handler.save_failed_request(
+                    prompt, persona=persona, index=current_index, error=model_response
+                )
+                continue
+            if metrics is not None:
+                metrics.record(model, prompt_version, persona, latency, model_response)
+            data_handler.save_model_response(
+                model_response, persona=persona, index=current_index
             )
 
-            if calcualate_cost:
+            if calcualate_cost and not model_response.get("cached"):
                 total_input_tokens += model_response["input_tokens"]
                 total_output_tokens += model_response["output_tokens"]
                 cost = model.calculate_cost(
@@ -62,6 +170,163 @@ def generate_inference_data(
                 )
 
 
+async def agenerate_inference_data(
+    data_handler: DataHandlerBase,
+    prompt_creator: PromptCreator,
+    model: Model,
+    total: int = -1,
+    calcualate_cost: bool = False,
+    concurrency: int = 8,
+    metrics: UsageMetrics = None,
+):
+    """
+    Asynchronous counterpart of `generate_inference_data`.
+
+    Every (data point, persona) pair becomes one work item and at most
+    `concurrency` of them are in flight at the same time. Data points are
+    pulled from the data handler lazily, so the work queue never holds more
+    than a few items per worker.
+    """
+    personas = data_handler.get_personas()
+    prompt_version = data_handler.get_prompt_version()
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    usage = {"input_tokens": 0, "output_tokens": 0}
+    progress = tqdm()
+
+    async def producer():
+        for data_point in data_handler.return_data_point(total):
+            for persona in personas:
+                await queue.put((data_point, persona))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            data_point, persona = item
+            current_index = data_point["ID"]
+            with tracer.span("render_prompt"):
+                prompt = prompt_creator.create_prompt(
+                    prompt=data_point["text"],
+                    persona=persona,
+                    domain=data_point["Domain"],
+                    version=prompt_version,
+                )
+            started = time.perf_counter()
+            try:
+                with tracer.span("request", index=str(current_index), persona=persona):
+                    model_response = await model.acreate_response(prompt)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.record_error(
+                        model, prompt_version, persona, time.perf_counter() - started
+                    )
+                data_handler.save_failed_request(
+                    prompt, persona=persona, index=current_index, error=e
+                )
+                continue
+            finally:
+                progress.update(1)
+            if metrics is not None:
+                metrics.record(
+                    model,
+                    prompt_version,
+                    persona,
+                    time.perf_counter() - started,
+                    model_response,
+                )
+
+            data_handler.save_model_response(
+                model_response, persona=persona, index=current_index
+            )
+
+            if calcualate_cost and not model_response.get("cached"):
+                usage["input_tokens"] += model_response["input_tokens"]
+                usage["output_tokens"] += model_response["output_tokens"]
+                cost = model.calculate_cost(
+                    model_response["input_tokens"], model_response["output_tokens"]
+                )
+                cost_till_now = model.calculate_cost(
+                    usage["input_tokens"], usage["output_tokens"]
+                )
+                logger.info(
+                    f"Cost for index {current_index}: {cost}, Total cost: {cost_till_now}"
+                )
+
+    try:
+        await asyncio.gather(producer(), *(worker() for _ in range(concurrency)))
+    finally:
+        progress.close()
+        await model.aclose()
+
+
+def is_local_model(model_name):
+    return "llama" in model_name.lower()
+
+
+def create_model(data_handler: DataHandler, api_key, token) -> Model:
+    model_name = data_handler.get_model_name()
+    if is_local_model(model_name):
+        # torch and transformers are only needed for the local model
+        from Llama3 import Llama3
+
+        model = Llama3(
+            model_name=model_name,
+            device=data_handler.get_config_value("device", "cuda"),
+            token=token,
+            load_in_4bit=data_handler.get_config_value("load_in_4bit", True),
+            reuse_prefix_cache=data_handler.get_config_value(
+                "reuse_prefix_cache", True
+            ),
+            # USD per million tokens, e.g. {"input": 0.05, "output": 0.2}
+            pricing=tuple(
+                data_handler.get_config_value("local_pricing", {}).get(key, 0.0) / 1e6
+                for key in ("input", "output")
+            ),
+        )
+        # decoding mode per prompt version, e.g. {1: "constrained", 2: "greedy"}
+        decoding = data_handler.get_config_value("decoding", {})
+        model.set_decoding_mode(
+            decoding.get(data_handler.get_prompt_version(), "beam")
+        )
+        model.activate_model()
+    elif data_handler.get_config_value("textgen"):
+        # e.g. {"urls": [...], "balancing": "least_loaded", "stream": True}
+        model = TextGenUIAPIModel(
+            model_name=model_name, **data_handler.get_config_value("textgen")
+        )
+    else:
+        rate_limit = data_handler.get_config_value("rate_limit")
+        rate_limiter = (
+            get_rate_limiter(model_name, **rate_limit) if rate_limit else None
+        )
+        model = ChatgptModel(
+            model_name=model_name,
+            key=api_key,
+            base_url=data_handler.get_config_value("base_url"),
+            rate_limiter=rate_limiter,
+            # retried by ResilientModel below
+            client_max_retries=0,
+        )
+    response_cache_config = data_handler.get_config_value("response_cache")
+    if response_cache_config:
+        model.response_cache = ResponseCache(**response_cache_config)
+
+    # retries, timeouts and the circuit breaker, e.g. {"max_retries": 5, "timeout": 60}
+    resilience = dict(data_handler.get_config_value("resilience", {}))
+    circuit_breaker = model_circuit_breaker(
+        model,
+        **{
+            key: resilience.pop(key)
+            for key in ("failure_threshold", "reset_timeout", "give_up_after")
+            if key in resilience
+        },
+    )
+    return ResilientModel(model, circuit_breaker=circuit_breaker, **resilience)
+
+
 def sanitize_log_name(filename):
     return filename.replace(" ", "_").replace(":", "_").replace("-", "_")
 
@@ -72,7 +337,59 @@ def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", type=str, default="config.yaml")
     parser.add_argument("--total", type=int, default=-1)
-    parser.add_argument("--calculate_cost", type=bool, default=False)
+    parser.add_argument("--calculate_cost", action="store_true")
+    parser.add_argument(
+        "--preflight",
+        action="store_true",
+        help="count the tokens of the pending prompts and project cost and time, without sending them",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="record the time spent per stage and write it to this Chrome trace file",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        help="number of requests in flight at once; values above 1 use the async engine",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="submit all pending prompts through the OpenAI Batch API",
+    )
+    parser.add_argument(
+        "--generation_batch_size",
+        type=int,
+        default=1,
+        help="number of prompts the local model generates together in one batch",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="i/N: only handle the data points whose ID hashes to shard i of N",
+    )
+    parser.add_argument(
+        "--queue",
+        type=str,
+        default=None,
+        help="SQLite work queue shared by the workers splitting this job",
+    )
+    parser.add_argument(
+        "--replay_dead_letters",
+        action="store_true",
+        help="only send the requests that failed in earlier runs again",
+    )
+    parser.add_argument("--worker_id", type=str, default=default_worker_id())
+    parser.add_argument(
+        "--lease_seconds",
+        type=float,
+        default=600,
+        help="time after which a data point claimed by a crashed worker is handed out again",
+    )
     return parser.parse_args()
 
 
@@ -86,27 +403,114 @@ if __name__ == "__main__":
     with open("hf_token.txt", "r") as f:
         token = f.read().strip("\n")
 
-    data_handler = DataHandler(args.config)
+    if args.trace is not None:
+        tracer.enable()
+    data_handler = create_data_handler(args.config)
+    if args.shard is not None:
+        data_handler.set_shard(*args.shard)
 
     if "gpt" in data_handler.get_model_name():
         with open(".env", "w") as f:
             api_key = f.read().strip()
     else:
         api_key = ""
+    prompt_registry.compile(
+        [data_handler.get_prompt_version()], data_handler.get_personas(), ["chat"]
+    )
     message_creator = ChatGptMessageCreator()
     logger.info(f"Model name: {data_handler.get_model_name()}")
-    model = ChatgptModel(
-        model_name=data_handler.get_model_name(),
-        key=api_key,
-    )
-    # model.activate_model()
+    model = create_model(data_handler, api_key=api_key, token=token)
+    if args.preflight:
+        preflight(
+            data_handler,
+            message_creator,
+            model,
+            total=args.total,
+            latency=data_handler.get_config_value("expected_latency", 1.0),
+            concurrency=max(args.concurrency, args.generation_batch_size),
+            cost_factor=batch_discount if args.batch else 1.0,
+        )
+        raise SystemExit(0)
+
+    # after the preflight, which only reads the pending data points and mustn't lease them
+    if args.queue is not None:
+        data_handler.set_work_queue(
+            WorkQueue(args.queue, lease_seconds=args.lease_seconds),
+            worker_id=args.worker_id,
+        )
+
+    # e.g. {"path": "storage/metrics.json", "prometheus_path": "storage/metrics.prom", "interval": 30}
+    usage_metrics = UsageMetrics()
+    exporter = MetricsExporter(
+        usage_metrics, **data_handler.get_config_value("metrics", {})
+    ).start()
     logger.info("Data generation started")
-    generate_inference_data(
-        data_handler=data_handler,
-        prompt_creator=message_creator,
-        model=model,
-        total=args.total,
-        calcualate_cost=args.calculate_cost,
-    )
+    if args.replay_dead_letters:
+        replay_dead_letters(data_handler, model, metrics=usage_metrics)
+    elif args.batch:
+        generate_batch_inference_data(
+            data_handler=data_handler,
+            prompt_creator=message_creator,
+            model=model,
+            batch_client=OpenAIBatchClient(
+                key=api_key, base_url=data_handler.get_config_value("base_url")
+            ),
+            batch_folder=data_handler.get_config_value(
+                "batch_folder_path", "../Data/Batches/"
+            ),
+            total=args.total,
+            calcualate_cost=args.calculate_cost,
+            poll_interval=data_handler.get_config_value("batch_poll_interval", 60),
+            metrics=usage_metrics,
+        )
+    elif args.generation_batch_size > 1:
+        generate_batched_inference_data(
+            data_handler=data_handler,
+            prompt_creator=message_creator,
+            model=model,
+            total=args.total,
+            calcualate_cost=args.calculate_cost,
+            batch_size=args.generation_batch_size,
+            metrics=usage_metrics,
+        )
+    elif args.concurrency > 1:
+        asyncio.run(
+            agenerate_inference_data(
+                data_handler=data_handler,
+                prompt_creator=message_creator,
+                model=model,
+                total=args.total,
+                calcualate_cost=args.calculate_cost,
+                concurrency=args.concurrency,
+                metrics=usage_metrics,
+            )
+        )
+    else:
+        generate_inference_data(
+            data_handler=data_handler,
+            prompt_creator=message_creator,
+            model=model,
+            total=args.total,
+            calcualate_cost=args.calculate_cost,
+            metrics=usage_metrics,
+        )
+
+    snapshot = exporter.stop()
+    print_summary(snapshot)
+    logger.info(f"Total cost: {snapshot['cost']}")
+    if args.trace is not None:
+        tracer.write(args.trace)
+        tracer.print_summary()
+    emotion_counts_path = data_handler.get_config_value("emotion_counts_path")
+    if emotion_counts_path and isinstance(data_handler, ResultStoreDataHandler):
+        # the normalizer is only needed for the counts
+        from aggregation import create_emotion_counts, write_ordered_lists
 
+        emotion_counts = create_emotion_counts(
+            emotion_counts_path, data_handler.get_config_value("substitutions_path")
+        )
+        emotion_counts.update(data_handler.store)
+        ordered_list_folder = data_handler.get_config_value("ordered_list_folder")
+        if ordered_list_folder:
+            write_ordered_lists(emotion_counts, ordered_list_folder)
     logger.info("Data generation finished")
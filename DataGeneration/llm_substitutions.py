@@ -0,0 +1,226 @@
+"""
+LLM-assisted substitutions for the free-form responses.
+
+Responses that neither are a single word nor have a substitution yet (see
+`postprocess.ResponseNormalizer.unmatched`) are collected over every model,
+persona and prompt version of a result store, so each distinct phrase is
+sent once. The phrases are packed into requests up to a token budget, sent
+concurrently and answered as JSON; the resolved phrases are appended to a
+substitution file that every later run (and `postprocess.py`) starts from.
+
+    $ export OPENAI_API_KEY=...
+    $ python llm_substitutions.py --store ../Data/results.sqlite --substitutions ../Data/substitutions.jsonl
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+
+from tqdm import tqdm
+
+from models import ChatgptModel, MalformedResponseError, Model
+from postprocess import ResponseNormalizer, load_substitutions
+from prompt_creator import emotion_words_V1
+from rate_limiter import estimate_tokens, get_rate_limiter
+from resilience import ResilientModel
+
+logger = logging.getLogger(__name__)
+
+system_instruction = """You are good at parsing Bangla. You will get a JSON list of Bangla phrases that express some emotion, each with an "id".
+Your work is to extract the emotion from each phrase and express it in ONE WORD. Remember the emotion might not be explicitly mentioned always. In those cases infer it from the phrase.
+You can select from the following emotions: %s but you can also use other words if you think the emotion is not in the list.
+Answer with a JSON object of the form {"answers": [{"id": <id>, "emotion": "<one word>"}]} containing every id.
+For example [{"id": 0, "phrase": "আমি ব্যস্ত।"}, {"id": 1, "phrase": "আমার জন্য আদর্শ এবং শ্রদ্ধা।"}] is answered with
+{"answers": [{"id": 0, "emotion": "ব্যস্ত"}, {"id": 1, "emotion": "শ্রদ্ধা"}]} (আদর্শ is not an emotion word)."""
+
+
+class SubstitutionStore:
+    """
+    Append-only JSONL file of resolved phrases. Each line keeps the phrase,
+    its replacement and the model that resolved it, so a phrase is never
+    sent again once it is in the file.
+    """
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.substitutions = load_substitutions(path) if os.path.exists(path) else {}
+
+    def __contains__(self, phrase):
+        return phrase in self.substitutions
+
+    def __len__(self):
+        return len(self.substitutions)
+
+    def add(self, substitutions, model_name):
+        with self.lock:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, "a", encoding="utf-8") as file:
+                for phrase, replacement in substitutions.items():
+                    entry = {
+                        "response": phrase,
+                        "replacement": replacement,
+                        "model": model_name,
+                        "resolved_at": time.time(),
+                    }
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.substitutions.update(substitutions)
+
+
+def pack_phrases(phrases, token_budget=1500, max_phrases=100):
+    """Group the phrases into requests of at most `token_budget` estimated input tokens."""
+    batch = []
+    tokens = 0
+    for phrase in phrases:
+        # the id and the JSON around every phrase take a few tokens too
+        phrase_tokens = estimate_tokens(phrase, completion_tokens=0) + 8
+        if batch and (tokens + phrase_tokens > token_budget or len(batch) == max_phrases):
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append(phrase)
+        tokens += phrase_tokens
+    if batch:
+        yield batch
+
+
+def create_message(phrases):
+    items = [{"id": i, "phrase": phrase} for i, phrase in enumerate(phrases)]
+    return [
+        {
+            "role": "system",
+            "content": system_instruction.replace("\n", " ") % ", ".join(emotion_words_V1),
+        },
+        {"role": "user", "content": json.dumps(items, ensure_ascii=False)},
+    ]
+
+
+def parse_answers(content, phrases):
+    """Map the phrases to the emotions of a JSON answer; phrases without an answer are left out."""
+    try:
+        answers = json.loads(content)["answers"]
+        resolved = {}
+        for answer in answers:
+            i = int(answer["id"])
+            emotion = str(answer["emotion"]).strip()
+            if 0 <= i < len(phrases) and emotion:
+                resolved[phrases[i]] = emotion
+    except (ValueError, KeyError, TypeError) as e:
+        raise MalformedResponseError(f"Unexpected answer: {content[:200]}") from e
+    return resolved
+
+
+async def resolve_phrases(
+    phrases,
+    model: Model,
+    store: SubstitutionStore,
+    concurrency=8,
+    token_budget=1500,
+    max_phrases=100,
+    max_attempts=3,
+):
+    """
+    Resolve the phrases that aren't in `store` yet with `concurrency`
+    requests in flight. Phrases left out of an answer, or whose answer
+    wasn't valid JSON, are sent again up to `max_attempts` times. Returns
+    the number of phrases resolved.
+    """
+    pending = sorted({phrase for phrase in phrases if phrase not in store})
+    queue = asyncio.Queue()
+    for batch in pack_phrases(pending, token_budget, max_phrases):
+        queue.put_nowait((batch, 1))
+    logger.info(f"Resolving {len(pending)} phrases in {queue.qsize()} requests")
+    progress = tqdm(total=len(pending))
+    resolved = 0
+
+    async def worker():
+        nonlocal resolved
+        while not queue.empty():
+            batch, attempt = queue.get_nowait()
+            try:
+                model_response = await model.acreate_response(create_message(batch))
+                substitutions = parse_answers(model_response["content"], batch)
+            except MalformedResponseError as e:
+                logger.warning(f"Attempt {attempt} for {len(batch)} phrases failed: {e}")
+                substitutions = {}
+            except Exception as e:
+                logger.error(f"Failed to resolve {len(batch)} phrases: {e!r}")
+                continue
+            store.add(substitutions, model.model_name)
+            resolved += len(substitutions)
+            progress.update(len(substitutions))
+            missing = [phrase for phrase in batch if phrase not in substitutions]
+            if missing and attempt < max_attempts:
+                queue.put_nowait((missing, attempt + 1))
+            elif missing:
+                # left for the next run
+                logger.warning(f"{len(missing)} phrases were not answered")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        progress.close()
+        await model.aclose()
+    return resolved
+
+
+def create_substitution_model(model_name, api_key, base_url=None, rate_limit=None):
+    model = ChatgptModel(
+        model_name=model_name,
+        key=api_key,
+        base_url=base_url,
+        rate_limiter=get_rate_limiter(model_name, **rate_limit) if rate_limit else None,
+        client_max_retries=0,
+    )
+    model.generation_params["response_format"] = {"type": "json_object"}
+    return ResilientModel(model)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, required=True)
+    parser.add_argument("--model", type=str, default="gpt-4o-mini")
+    parser.add_argument("--base_url", type=str, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--token_budget",
+        type=int,
+        default=1500,
+        help="estimated input tokens of the phrases in one request",
+    )
+    parser.add_argument("--max_phrases", type=int, default=100)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from result_store import ResultStore
+
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    store = SubstitutionStore(args.substitutions)
+    normalizer = ResponseNormalizer(store.substitutions)
+    # every model, persona and prompt version at once
+    results = ResultStore(args.store).to_dataframe()
+    phrases = normalizer.unmatched(results["content"])
+    model = create_substitution_model(
+        args.model, os.environ.get("OPENAI_API_KEY"), base_url=args.base_url
+    )
+    resolved = asyncio.run(
+        resolve_phrases(
+            phrases,
+            model,
+            store,
+            concurrency=args.concurrency,
+            token_budget=args.token_budget,
+            max_phrases=args.max_phrases,
+        )
+    )
+    print(f"Resolved {resolved} of {len(phrases)} phrases, {len(store)} substitutions in {args.substitutions}")
@@ -0,0 +1,308 @@
+"""
+Usage metrics of a generation run.
+
+Every request is recorded per (model, prompt version, persona): tokens,
+cost, latency, errors and cache hits. A snapshot can be written periodically
+as JSON and in the Prometheus text format (e.g. for node_exporter's textfile
+collector), and `preflight` projects the tokens, cost and time of the pending
+prompts before any request is sent.
+"""
+
+from collections import deque
+import json
+import logging
+import os
+import threading
+import time
+
+from models import Model
+from tracing import percentile, print_table
+
+logger = logging.getLogger(__name__)
+
+metric_prefix = "emotion_bias"
+latency_window = 10000
+
+
+class SeriesMetrics:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.errors = 0
+        self.cached = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        # latencies of the most recent requests, for the percentiles
+        self.latencies = deque(maxlen=latency_window)
+
+
+class UsageMetrics:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.series = {}
+        self.cost_functions = {}
+        self.started = time.monotonic()
+
+    def __series(self, model: Model, prompt_version, persona):
+        key = (model.model_name, prompt_version, persona)
+        if key not in self.series:
+            self.series[key] = SeriesMetrics()
+            self.cost_functions.setdefault(model.model_name, model.calculate_cost)
+        return self.series[key]
+
+    def set_cost_function(self, model_name, cost_function):
+        """Price the tokens of `model_name` with `cost_function` instead of its `calculate_cost`."""
+        with self.lock:
+            self.cost_functions[model_name] = cost_function
+
+    def record(self, model: Model, prompt_version, persona, latency, model_response):
+        with self.lock:
+            series = self.__series(model, prompt_version, persona)
+            series.requests += 1
+            if model_response.get("cached"):
+                # nothing was sent, so neither tokens nor latency count
+                series.cached += 1
+                return
+            series.input_tokens += model_response.get("input_tokens", 0)
+            series.output_tokens += model_response.get("output_tokens", 0)
+            if latency is not None:
+                series.latencies.append(latency)
+
+    def record_error(self, model: Model, prompt_version, persona, latency=None):
+        with self.lock:
+            series = self.__series(model, prompt_version, persona)
+            series.requests += 1
+            series.errors += 1
+            if latency is not None:
+                series.latencies.append(latency)
+
+    def __cost(self, model_name, input_tokens, output_tokens):
+        try:
+            return self.cost_functions[model_name](input_tokens, output_tokens)
+        except ValueError:
+            # no pricing known for the model
+            return None
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            series = []
+            for (model_name, prompt_version, persona), metrics in self.series.items():
+                latencies = list(metrics.latencies)
+                series.append(
+                    {
+                        "model": model_name,
+                        "prompt_version": prompt_version,
+                        "persona": persona,
+                        "requests": metrics.requests,
+                        "errors": metrics.errors,
+                        "error_rate": metrics.errors / metrics.requests,
+                        "cached": metrics.cached,
+                        "input_tokens": metrics.input_tokens,
+                        "output_tokens": metrics.output_tokens,
+                        "cost": self.__cost(
+                            model_name, metrics.input_tokens, metrics.output_tokens
+                        ),
+                        "requests_per_second": metrics.requests / elapsed,
+                        "latency_p50": percentile(latencies, 50),
+                        "latency_p90": percentile(latencies, 90),
+                        "latency_p99": percentile(latencies, 99),
+                    }
+                )
+        costs = [row["cost"] for row in series if row["cost"] is not None]
+        return {
+            "timestamp": time.time(),
+            "elapsed_seconds": elapsed,
+            "requests": sum(row["requests"] for row in series),
+            "errors": sum(row["errors"] for row in series),
+            "input_tokens": sum(row["input_tokens"] for row in series),
+            "output_tokens": sum(row["output_tokens"] for row in series),
+            "cost": sum(costs) if costs else None,
+            "series": series,
+        }
+
+    def total_cost(self):
+        return self.snapshot()["cost"]
+
+
+def to_prometheus(snapshot):
+    counters = [
+        ("requests_total", "requests", "counter", "Requests to the model, cache hits included."),
+        ("errors_total", "errors", "counter", "Requests that failed."),
+        ("cached_total", "cached", "counter", "Requests answered from the response cache."),
+        ("input_tokens_total", "input_tokens", "counter", "Prompt tokens sent."),
+        ("output_tokens_total", "output_tokens", "counter", "Completion tokens received."),
+        ("cost_usd", "cost", "gauge", "Cost of the tokens so far."),
+        ("requests_per_second", "requests_per_second", "gauge", "Requests per second since the start."),
+    ]
+    lines = []
+    for name, field, metric_type, description in counters:
+        lines.append(f"# HELP {metric_prefix}_{name} {description}")
+        lines.append(f"# TYPE {metric_prefix}_{name} {metric_type}")
+        for row in snapshot["series"]:
+            if row[field] is None:
+                continue
+            lines.append(f"{metric_prefix}_{name}{{{labels(row)}}} {row[field]}")
+    name = f"{metric_prefix}_request_latency_seconds"
+    lines.append(f"# HELP {name} Latency of the requests.")
+    lines.append(f"# TYPE {name} summary")
+    for row in snapshot["series"]:
+        for quantile in (50, 90, 99):
+            lines.append(
+                f'{name}{{{labels(row)},quantile="{quantile / 100}"}} {row[f"latency_p{quantile}"]}'
+            )
+    return "\n".join(lines) + "\n"
+
+
+def labels(row):
+    return f'model="{row["model"]}",prompt_version="{row["prompt_version"]}",persona="{row["persona"]}"'
+
+
+def write_atomically(path, text):
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    temporary_path = f"{path}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(temporary_path, path)
+
+
+class MetricsExporter:
+    """Writes a snapshot of `metrics` every `interval` seconds from a background thread."""
+
+    def __init__(self, metrics: UsageMetrics, path=None, prometheus_path=None, interval=30) -> None:
+        self.metrics = metrics
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+
+    def export(self):
+        snapshot = self.metrics.snapshot()
+        if self.path is not None:
+            write_atomically(self.path, json.dumps(snapshot, indent=2, ensure_ascii=False))
+        if self.prometheus_path is not None:
+            write_atomically(self.prometheus_path, to_prometheus(snapshot))
+        return snapshot
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.export()
+            except OSError as e:
+                logger.error(f"Error occurred while exporting metrics: {e}")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+        return self.export()
+
+
+def print_summary(snapshot):
+    rows = [
+        {
+            "model": row["model"],
+            "version": row["prompt_version"],
+            "persona": row["persona"],
+            "requests": row["requests"],
+            "errors": f"{100 * row['error_rate']:.1f}%",
+            "cached": row["cached"],
+            "tokens_in": row["input_tokens"],
+            "tokens_out": row["output_tokens"],
+            "cost": "-" if row["cost"] is None else f"{row['cost']:.4f}",
+            "rps": f"{row['requests_per_second']:.2f}",
+            "p50_ms": f"{1000 * row['latency_p50']:.0f}",
+            "p99_ms": f"{1000 * row['latency_p99']:.0f}",
+        }
+        for row in snapshot["series"]
+    ]
+    if rows:
+        print_table(rows, list(rows[0]))
+
+
+def preflight(
+    data_handler,
+    prompt_creator,
+    model: Model,
+    total=-1,
+    output_tokens_per_request=4,
+    latency=1.0,
+    concurrency=1,
+    cost_factor=1.0,
+):
+    """
+    Count the tokens of the pending prompts locally and project the cost and
+    duration of sending them. The duration is bounded by `concurrency`
+    requests of `latency` seconds in flight and by the config's rate limit.
+    """
+    prompt_version = data_handler.get_prompt_version()
+    personas = data_handler.get_personas()
+    requests = {persona: 0 for persona in personas}
+    input_tokens = {persona: 0 for persona in personas}
+    for data_point in data_handler.return_data_point(total):
+        for persona in personas:
+            prompt = prompt_creator.create_prompt(
+                prompt=data_point["text"],
+                persona=persona,
+                domain=data_point["Domain"],
+                version=prompt_version,
+            )
+            requests[persona] += 1
+            input_tokens[persona] += model.count_tokens(prompt)
+
+    rows = []
+    for persona in personas:
+        output_tokens = requests[persona] * output_tokens_per_request
+        try:
+            cost = model.calculate_cost(input_tokens[persona], output_tokens)
+        except ValueError:
+            cost = None
+        if cost is not None:
+            cost *= cost_factor
+        rows.append(
+            {
+                "model": model.model_name,
+                "version": prompt_version,
+                "persona": persona,
+                "requests": requests[persona],
+                "tokens_in": input_tokens[persona],
+                "tokens_out": output_tokens,
+                "cost": cost,
+            }
+        )
+
+    total_requests = sum(requests.values())
+    total_tokens = sum(input_tokens.values()) + total_requests * output_tokens_per_request
+    seconds = total_requests * latency / max(concurrency, 1)
+    rate_limit = data_handler.get_config_value("rate_limit") or {}
+    if rate_limit.get("requests_per_minute"):
+        seconds = max(seconds, 60 * total_requests / rate_limit["requests_per_minute"])
+    if rate_limit.get("tokens_per_minute"):
+        seconds = max(seconds, 60 * total_tokens / rate_limit["tokens_per_minute"])
+    costs = [row["cost"] for row in rows if row["cost"] is not None]
+
+    print_table(
+        [
+            {**row, "cost": "-" if row["cost"] is None else f"{row['cost']:.4f}"}
+            for row in rows
+        ],
+        ["model", "version", "persona", "requests", "tokens_in", "tokens_out", "cost"],
+    )
+    projection = {
+        "requests": total_requests,
+        "tokens": total_tokens,
+        "cost": sum(costs) if costs else None,
+        "seconds": seconds,
+    }
+    cost = "-" if projection["cost"] is None else f"{projection['cost']:.2f}"
+    print(
+        f"Projected: {total_requests} requests, {total_tokens} tokens, "
+        f"cost {cost}, about {seconds / 3600:.2f} hours"
+    )
+    return projection
@@ -0,0 +1,247 @@
+"""
+Local stand-in for the OpenAI chat completions endpoint.
+
+It answers every request with one of the I1 emotion words and enforces
+requests-per-minute and tokens-per-minute quotas the same way the real API
+does: rejected requests get a 429 with a Retry-After header, and every
+response carries the x-ratelimit-* headers. Requests with `"stream": true`
+are answered as server-sent events, the emotion word followed by a few more
+words. Point a model at it with `base_url: http://127.0.0.1:<port>/v1` in the
+config file (or `http://127.0.0.1:<port>/v1/chat/completions` in the
+`textgen` urls).
+
+    $ python mock_server.py --port 8000 --rpm 60 --tpm 10000 --latency 0.2
+"""
+
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from prompt_creator import emotion_words_V1
+
+
+class Quota:
+    def __init__(self, per_minute) -> None:
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.capacity / 60.0
+        )
+        self.updated = now
+
+    def seconds_until(self, amount):
+        return max(0.0, (amount - self.level) * 60.0 / self.capacity)
+
+
+class MockState:
+    def __init__(self, rpm, tpm, latency, error_rate) -> None:
+        self.requests = Quota(rpm)
+        self.tokens = Quota(tpm)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.stats = {"completed": 0, "rate_limited": 0, "errors": 0, "connections": 0}
+
+    def admit(self, tokens):
+        """Charge a request against the quotas; returns (retry_after, headers)."""
+        with self.lock:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            retry_after = max(
+                self.requests.seconds_until(1), self.tokens.seconds_until(tokens)
+            )
+            if retry_after == 0:
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+            else:
+                self.stats["rate_limited"] += 1
+            headers = {
+                "x-ratelimit-limit-requests": str(int(self.requests.capacity)),
+                "x-ratelimit-remaining-requests": str(int(self.requests.level)),
+                "x-ratelimit-reset-requests": f"{self.requests.seconds_until(self.requests.capacity):.3f}s",
+                "x-ratelimit-limit-tokens": str(int(self.tokens.capacity)),
+                "x-ratelimit-remaining-tokens": str(int(self.tokens.level)),
+                "x-ratelimit-reset-tokens": f"{self.tokens.seconds_until(self.tokens.capacity):.3f}s",
+            }
+            return retry_after, headers
+
+
+def request_tokens(messages):
+    return sum(len(message["content"]) for message in messages) // 4 + 4 * len(
+        messages
+    )
+
+
+def make_handler(state: MockState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written separately; without TCP_NODELAY kept
+        # alive connections wait for the client's delayed ACK on every response
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def setup(self):
+            super().setup()
+            with state.lock:
+                state.stats["connections"] += 1
+
+        def read_json(self):
+            length = int(self.headers.get("Content-Length", 0))
+            return json.loads(self.rfile.read(length) or b"{}")
+
+        def send_stream(self, words, headers):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            events = [
+                {"choices": [{"index": 0, "delta": {"content": word}}]} for word in words
+            ]
+            try:
+                for event in events:
+                    self.write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n")
+                    if state.latency:
+                        time.sleep(state.latency / len(events))
+                self.write_chunk("data: [DONE]\n\n")
+                self.write_chunk("")
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading after the first word
+                self.close_connection = True
+
+        def write_chunk(self, text):
+            payload = text.encode("utf-8")
+            self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/stats":
+                with state.lock:
+                    self.send_json(200, dict(state.stats))
+            else:
+                self.send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "not found"}})
+                return
+            body = self.read_json()
+            messages = body.get("messages", [])
+            input_tokens = request_tokens(messages)
+            retry_after, headers = state.admit(input_tokens + 1)
+            if retry_after > 0:
+                headers["retry-after"] = f"{retry_after:.3f}"
+                headers["retry-after-ms"] = str(int(retry_after * 1000))
+                self.send_json(
+                    429,
+                    {
+                        "error": {
+                            "message": "Rate limit reached",
+                            "type": "requests",
+                            "code": "rate_limit_exceeded",
+                        }
+                    },
+                    headers,
+                )
+                return
+            if state.latency and not body.get("stream"):
+                time.sleep(random.expovariate(1 / state.latency))
+            if random.random() < state.error_rate:
+                with state.lock:
+                    state.stats["errors"] += 1
+                self.send_json(500, {"error": {"message": "Internal server error"}})
+                return
+
+            with state.lock:
+                state.stats["completed"] += 1
+            if body.get("stream"):
+                word = random.choice(emotion_words_V1)
+                self.send_stream([word, " লাগছে", "।", " কারণ", " মন্তব্যটি", " শুনে"], headers)
+                return
+            self.send_json(
+                200,
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": random.choice(emotion_words_V1),
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": input_tokens,
+                        "completion_tokens": 1,
+                        "total_tokens": input_tokens + 1,
+                    },
+                },
+                headers,
+            )
+
+    return Handler
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def serve(host="127.0.0.1", port=8000, rpm=500, tpm=30000, latency=0.0, error_rate=0.0):
+    """Start the mock server on a background thread and return it."""
+    state = MockState(rpm, tpm, latency, error_rate)
+    server = MockHTTPServer((host, port), make_handler(state))
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--rpm", type=int, default=500)
+    parser.add_argument("--tpm", type=int, default=30000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error_rate", type=float, default=0.0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    server = serve(
+        args.host, args.port, args.rpm, args.tpm, args.latency, args.error_rate
+    )
+    print(f"Mock server listening on http://{args.host}:{server.server_port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
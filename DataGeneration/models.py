@@ -1,6 +1,21 @@
 from abc import ABC, abstractmethod
+import asyncio
+from contextlib import contextmanager
+import json
+import threading
+import httpx
 import requests
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI, RateLimitError
+from requests.adapters import HTTPAdapter
+from prompt_creator import strip_leading_boundary, word_boundary
+from rate_limiter import estimate_tokens, retry_after_seconds
+from response_cache import cached
+from tracing import tracer
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 pricing_option = {
     "gpt-3.5-turbo": (0.5 / 1e6, 1.5 / 1e6),
@@ -8,27 +23,71 @@ pricing_option = {
 }
 
 
+class MalformedResponseError(ValueError):
+    """The backend answered, but not with a chat completion."""
+
+
 class Model(ABC):
+    def __init__(self) -> None:
+        self.model_name = None
+        # parameters that change the response for a given message list; they
+        # are part of the response cache key
+        self.generation_params = {}
+        self.response_cache = None
+        # seconds a single request may take, None for the backend's default
+        self.request_timeout = None
+
     @abstractmethod
     def create_response(self, model_message):
         pass
 
+    def create_batch_response(self, model_messages):
+        # backends that can't run several prompts in one call answer them in turn
+        return [self.create_response(model_message) for model_message in model_messages]
+
+    async def acreate_response(self, model_message):
+        # backends without a native async client run the blocking call in a
+        # worker thread so that they can still be driven concurrently
+        return await asyncio.to_thread(self.create_response, model_message)
+
+    async def aclose(self):
+        pass
+
+    def count_tokens(self, model_message):
+        # models without a local tokenizer fall back to the character estimate
+        return estimate_tokens(model_message, completion_tokens=0)
+
     @abstractmethod
     def calculate_cost(self, input_tokens, output_tokens):
         pass
 
 
 class ChatgptModel(Model):
-    def __init__(self, model_name, key) -> None:
+    def __init__(
+        self,
+        model_name,
+        key,
+        base_url=None,
+        rate_limiter=None,
+        max_rate_limit_retries=8,
+        client_max_retries=2,
+    ) -> None:
         super().__init__()
         self.model_name = model_name
-        self.client = OpenAI(api_key=key)
-
-    def create_response(self, model_message) -> dict:
-        completion = self.client.chat.completions.create(
-            model=self.model_name, messages=model_message, temperature=0.1
+        self.generation_params = {"temperature": 0.1}
+        self.key = key
+        self.base_url = base_url
+        self.rate_limiter = rate_limiter
+        self.max_rate_limit_retries = max_rate_limit_retries
+        # with a rate limiter in place, 429s are retried here so that the
+        # limiter sees them instead of the client's own backoff
+        self.client_max_retries = 0 if rate_limiter is not None else client_max_retries
+        self.client = OpenAI(
+            api_key=key, base_url=base_url, max_retries=self.client_max_retries
         )
+        self.async_client = None
 
+    def __parse_completion(self, completion) -> dict:
         response = {
             "content": completion.choices[0].message.content,
             "total_tokens": completion.usage.total_tokens,
@@ -38,6 +97,89 @@ class ChatgptModel(Model):
 
         return response
 
+    def __request_options(self):
+        options = dict(self.generation_params)
+        if self.request_timeout is not None:
+            options["timeout"] = self.request_timeout
+        return options
+
+    def __on_rate_limited(self, error, attempt):
+        if self.rate_limiter is None or attempt == self.max_rate_limit_retries:
+            raise error
+        self.rate_limiter.on_rate_limited(retry_after_seconds(error.response.headers))
+
+    def __on_completion(self, raw_completion, estimated_tokens) -> dict:
+        with tracer.span("parse"):
+            response = self.__parse_completion(raw_completion.parse())
+        if self.rate_limiter is not None:
+            self.rate_limiter.update_from_headers(raw_completion.headers)
+            self.rate_limiter.record_usage(estimated_tokens, response["total_tokens"])
+        return response
+
+    @cached
+    def create_response(self, model_message) -> dict:
+        estimated_tokens = estimate_tokens(model_message)
+        for attempt in range(self.max_rate_limit_retries + 1):
+            if self.rate_limiter is not None:
+                with tracer.span("rate_limit_wait"):
+                    self.rate_limiter.acquire(estimated_tokens)
+            try:
+                with tracer.span("network"):
+                    raw_completion = self.client.chat.completions.with_raw_response.create(
+                        model=self.model_name,
+                        messages=model_message,
+                        **self.__request_options(),
+                    )
+            except RateLimitError as e:
+                self.__on_rate_limited(e, attempt)
+                continue
+            return self.__on_completion(raw_completion, estimated_tokens)
+
+    @cached
+    async def acreate_response(self, model_message) -> dict:
+        # the async client is created lazily so that it binds to the running loop
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(
+                api_key=self.key,
+                base_url=self.base_url,
+                max_retries=self.client_max_retries,
+            )
+        estimated_tokens = estimate_tokens(model_message)
+        for attempt in range(self.max_rate_limit_retries + 1):
+            if self.rate_limiter is not None:
+                with tracer.span("rate_limit_wait"):
+                    await self.rate_limiter.aacquire(estimated_tokens)
+            try:
+                with tracer.span("network"):
+                    raw_completion = (
+                        await self.async_client.chat.completions.with_raw_response.create(
+                            model=self.model_name,
+                            messages=model_message,
+                            **self.__request_options(),
+                        )
+                    )
+            except RateLimitError as e:
+                self.__on_rate_limited(e, attempt)
+                continue
+            return self.__on_completion(raw_completion, estimated_tokens)
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+
+    def count_tokens(self, model_message):
+        if tiktoken is None:
+            return super().count_tokens(model_message)
+        try:
+            encoding = tiktoken.encoding_for_model(self.model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+        # every chat message carries a few tokens of formatting
+        return sum(
+            len(encoding.encode(message["content"])) + 4 for message in model_message
+        ) + 3
+
     def calculate_cost(self, input_tokens, output_tokens):
         if self.model_name not in pricing_option:
             raise ValueError("Model not found in pricing options")
@@ -45,15 +187,160 @@ class ChatgptModel(Model):
         return input_cost * input_tokens + output_cost * output_tokens
 
 
+class EndpointBalancer:
+    """
+    Spreads the requests over several backend URLs, either in turn
+    (`round_robin`) or to the URL with the fewest requests in flight
+    (`least_loaded`). With circuit breakers (see `use_circuit_breakers`) the
+    URLs whose circuit is open are skipped.
+    """
+
+    def __init__(self, urls, strategy="round_robin") -> None:
+        if strategy not in ("round_robin", "least_loaded"):
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.urls = list(urls)
+        self.strategy = strategy
+        self.in_flight = {url: 0 for url in self.urls}
+        self.next = 0
+        self.lock = threading.Lock()
+        self.circuit_breakers = None
+        self.is_transient = None
+
+    def use_circuit_breakers(self, circuit_breakers, is_transient):
+        """
+        `circuit_breakers` maps every URL to its breaker; the outcome of each
+        request is recorded on the breaker of the URL that served it, and
+        `is_transient(error)` tells which errors count as failures.
+        """
+        self.circuit_breakers = circuit_breakers
+        self.is_transient = is_transient
+
+    def __available(self, url):
+        try:
+            return self.circuit_breakers[url].wait_time() == 0
+        except Exception:
+            # the backend is down
+            return False
+
+    def acquire(self):
+        with self.lock:
+            candidates = self.urls[self.next :] + self.urls[: self.next]
+            if self.circuit_breakers is not None:
+                # if every circuit is open the request goes out anyway and fails
+                candidates = [url for url in candidates if self.__available(url)] or candidates
+            if self.strategy == "least_loaded":
+                # ties go round robin so that idle backends share the load
+                url = min(candidates, key=self.in_flight.get)
+            else:
+                url = candidates[0]
+            if self.circuit_breakers is not None:
+                # claims the probe of a half-open circuit
+                try:
+                    self.circuit_breakers[url].before_call()
+                except Exception:
+                    pass
+            self.next = (self.urls.index(url) + 1) % len(self.urls)
+            self.in_flight[url] += 1
+            return url
+
+    def release(self, url):
+        with self.lock:
+            self.in_flight[url] -= 1
+
+    def record(self, url, error=None):
+        if self.circuit_breakers is None:
+            return
+        if error is not None and self.is_transient(error):
+            self.circuit_breakers[url].record_failure()
+        else:
+            # an answer, even an error one, shows the backend is alive
+            self.circuit_breakers[url].record_success()
+
+    @contextmanager
+    def endpoint(self):
+        url = self.acquire()
+        try:
+            yield url
+        except Exception as e:
+            self.record(url, e)
+            raise
+        else:
+            self.record(url)
+        finally:
+            self.release(url)
+
+
+class StreamedAnswer:
+    """Collects the deltas of a streamed (SSE) chat completion up to the first word."""
+
+    def __init__(self) -> None:
+        self.content = ""
+
+    def feed(self, line) -> bool:
+        """Add one line of the stream; True once the first word is complete."""
+        if not line.startswith("data:"):
+            return False
+        payload = line[len("data:") :].strip()
+        if payload == "[DONE]":
+            return True
+        try:
+            delta = json.loads(payload)["choices"][0].get("delta", {})
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            raise MalformedResponseError(f"Unexpected stream chunk: {payload}") from e
+        self.content += delta.get("content") or ""
+        return word_boundary.search(strip_leading_boundary(self.content)) is not None
+
+    def response(self) -> dict:
+        content = strip_leading_boundary(self.content)
+        match = word_boundary.search(content)
+        return {"content": content if match is None else content[: match.start()]}
+
+
 class TextGenUIAPIModel(Model):
-    def create_response(self, model_message) -> dict:
+    """
+    Client of one or more text-generation-webui servers (OpenAI compatible
+    API). Connections are pooled and kept alive across requests. With
+    `stream=True` the answer is streamed and reading stops at the end of its
+    first word; the rest of that response is dropped together with its
+    connection.
+    """
 
-        url = "http://149.36.0.216:44147/v1/chat/completions"
+    url = "http://149.36.0.216:44147/v1/chat/completions"
+    headers = {"Content-Type": "application/json"}
 
-        headers = {"Content-Type": "application/json"}
-        data = {"mode": "instruct", "messages": model_message}
-        response = requests.post(url, headers=headers, json=data, verify=False)
-        assistant_message = response.json()["choices"][0]["message"]["content"]
+    def __init__(
+        self,
+        model_name="text-generation-webui",
+        urls=None,
+        balancing="round_robin",
+        stream=False,
+        max_connections=32,
+    ) -> None:
+        super().__init__()
+        self.model_name = model_name
+        self.generation_params = {"mode": "instruct"}
+        if stream:
+            # part of the cache key too, since only the first word is kept
+            self.generation_params["stream"] = True
+        self.stream = stream
+        self.balancer = EndpointBalancer(urls or [self.url], balancing)
+        self.max_connections = max_connections
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = False
+        adapter = HTTPAdapter(
+            pool_connections=len(self.balancer.urls), pool_maxsize=max_connections
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.async_client = None
+
+    @staticmethod
+    def parse_response(body) -> dict:
+        try:
+            assistant_message = body["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError) as e:
+            raise MalformedResponseError(f"Unexpected response body: {body}") from e
 
         response = {
             "content": assistant_message,
@@ -61,5 +348,70 @@ class TextGenUIAPIModel(Model):
 
         return response
 
+    @staticmethod
+    def parse_body(response) -> dict:
+        try:
+            body = response.json()
+        except ValueError as e:
+            raise MalformedResponseError(f"Response is not JSON: {response.text[:200]}") from e
+        return TextGenUIAPIModel.parse_response(body)
+
+    @cached
+    def create_response(self, model_message) -> dict:
+        data = {"messages": model_message, **self.generation_params}
+        with self.balancer.endpoint() as url, tracer.span("network", url=url):
+            if not self.stream:
+                response = self.session.post(url, json=data, timeout=self.request_timeout)
+                response.raise_for_status()
+                return self.parse_body(response)
+
+            answer = StreamedAnswer()
+            with self.session.post(
+                url, json=data, stream=True, timeout=self.request_timeout
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if answer.feed(line.decode("utf-8")):
+                        break
+            return answer.response()
+
+    @cached
+    async def acreate_response(self, model_message) -> dict:
+        # a single pooled client keeps the connections to the servers alive
+        # across requests instead of opening a new one per call
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(
+                headers=self.headers,
+                verify=False,
+                timeout=None,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        data = {"messages": model_message, **self.generation_params}
+        with self.balancer.endpoint() as url, tracer.span("network", url=url):
+            if not self.stream:
+                response = await self.async_client.post(
+                    url, json=data, timeout=self.request_timeout
+                )
+                response.raise_for_status()
+                return self.parse_body(response)
+
+            answer = StreamedAnswer()
+            async with self.async_client.stream(
+                "POST", url, json=data, timeout=self.request_timeout
+            ) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if answer.feed(line):
+                        break
+            return answer.response()
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
     def calculate_cost(self, input_tokens, output_tokens):
         pass
@@ -0,0 +1,189 @@
+"""
+Normalisation of the saved responses before the analysis.
+
+The steps of the analysis notebook (`normalize()` of the stripped response,
+the substitutions of the `a->b` file and the removal of the end marks) are
+applied per distinct response instead of per row: every distinct string is
+normalised once, looked up in a table keyed by the normalised substitution
+keys and mapped back to the rows with `pd.factorize`.
+
+    $ python postprocess.py --store ../Data/results.sqlite --substitutions ../Data/substitutions.txt \
+        --output ../Data/responses_normalized.csv --unmatched ../Data/unmatched.txt
+"""
+
+import json
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+def remove_end_marks(text):
+    return text.strip().rstrip("।").rstrip("!").rstrip(".").strip('"')
+
+
+def load_substitutions(path):
+    """
+    Read a substitution file: `response->replacement` lines, or JSON lines
+    with `response` and `replacement` (as written by llm_substitutions.py).
+    """
+    substitutions = {}
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith(".jsonl"):
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                substitutions[entry["response"]] = entry["replacement"]
+            return substitutions
+        for line in file:
+            line = line.strip("\n")
+            if "->" not in line:
+                continue
+            key, replacement = line.split("->", 1)
+            substitutions[key] = replacement.strip()
+    return substitutions
+
+
+class ResponseNormalizer:
+    """
+    Memoised normalisation of responses. `normalize_function` defaults to
+    `normalizer.normalize` (https://github.com/csebuetnlp/normalizer);
+    substitutions are stored under their normalised key, so a lookup is a
+    single hash probe.
+    """
+
+    def __init__(self, substitutions=None, normalize_function=None) -> None:
+        if normalize_function is None:
+            from normalizer import normalize as normalize_function
+        self.normalize_function = normalize_function
+        self.normalized = {}
+        self.resolved = {}
+        self.substitutions = {}
+        self.lock = threading.Lock()
+        self.add_substitutions(substitutions or {})
+
+    def normalize(self, text):
+        normalized = self.normalized.get(text)
+        if normalized is None:
+            normalized = self.normalize_function(text.strip()).strip()
+            self.normalized[text] = normalized
+        return normalized
+
+    def add_substitutions(self, substitutions):
+        with self.lock:
+            for key, replacement in substitutions.items():
+                # like the notebook, the first key in file order wins when several normalise alike
+                self.substitutions.setdefault(self.normalize(key), self.normalize(replacement))
+            # earlier results may change with the new substitutions
+            self.resolved = {}
+
+    def is_matched(self, normalized):
+        words = normalized.split()
+        return (
+            normalized in self.substitutions
+            or len(words) <= 1
+            or (len(words) == 2 and words[-1] == "।")
+        )
+
+    def resolve(self, text):
+        """The response as used in the analysis: normalised, substituted and without end marks."""
+        resolved = self.resolved.get(text)
+        if resolved is not None:
+            return resolved
+        normalized = self.normalize(text)
+        words = normalized.split()
+        if normalized in self.substitutions:
+            resolved = self.substitutions[normalized]
+        elif len(words) == 2 and words[-1] == "।":
+            resolved = words[0]
+        else:
+            resolved = normalized
+        resolved = remove_end_marks(resolved)
+        self.resolved[text] = resolved
+        return resolved
+
+    def resolve_series(self, responses: pd.Series) -> pd.Series:
+        codes, uniques = pd.factorize(responses.fillna("").astype(str))
+        resolved = np.array([self.resolve(text) for text in uniques], dtype=object)
+        return pd.Series(resolved[codes], index=responses.index, name=responses.name)
+
+    def unmatched(self, responses: pd.Series):
+        """Distinct normalised responses of more than one word that no substitution covers."""
+        normalized = {self.normalize(text) for text in responses.fillna("").astype(str).unique()}
+        return sorted(text for text in normalized if not self.is_matched(text))
+
+
+def normalize_results(results: pd.DataFrame, normalizer: ResponseNormalizer, column="content"):
+    """Add the resolved `response` column to a `ResultStore.to_dataframe()` frame."""
+    results = results.copy()
+    results["response"] = normalizer.resolve_series(results[column])
+    return results
+
+
+def to_wide(results: pd.DataFrame, column="response"):
+    """
+    One row per ID with a `<persona>_<model>_I<version>_response` column per
+    (persona, model, prompt version), the layout the notebook works on.
+    """
+    results = results.assign(
+        key=results["persona"]
+        + "_"
+        + results["model"]
+        + "_I"
+        + results["prompt_version"].astype(str)
+        + "_response"
+    )
+    wide = results.pivot(index="id", columns="key", values=column)
+    wide.columns.name = None
+    return wide.reset_index().rename(columns={"id": "ID"})
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, default=None)
+    parser.add_argument(
+        "--unmatched",
+        type=str,
+        default=None,
+        help="write the responses no substitution covers to this file, one per line",
+    )
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--prompt_version", type=int, default=None)
+    parser.add_argument(
+        "--emotion_data_path",
+        type=str,
+        default=None,
+        help="merge the responses into the dataset instead of writing them alone",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from result_store import ResultStore
+
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    substitutions = load_substitutions(args.substitutions) if args.substitutions else {}
+    normalizer = ResponseNormalizer(substitutions)
+    results = ResultStore(args.store).to_dataframe(args.model, args.prompt_version)
+    results = normalize_results(results, normalizer)
+    wide = to_wide(results)
+    if args.emotion_data_path is not None:
+        emotion_df = pd.read_csv(args.emotion_data_path)
+        wide = emotion_df.assign(ID=emotion_df["ID"].astype(str)).merge(wide, on="ID", how="left")
+    wide.to_csv(args.output, index=False)
+    print(f"Normalised {len(results)} responses ({len(normalizer.normalized)} distinct) to {args.output}")
+    if args.unmatched is not None:
+        unmatched = normalizer.unmatched(results["content"])
+        with open(args.unmatched, "w", encoding="utf-8") as file:
+            file.writelines(f"{text}\n" for text in unmatched)
+        print(f"{len(unmatched)} responses without substitution written to {args.unmatched}")
@@ -1,7 +1,20 @@
 from abc import ABC, abstractmethod
+import json
+import re
+import threading
 
 # Main emotions: anger, sadness, joy, surprise, fear, guilt, disgust, shame
 # রাগ, দুঃখ, আনন্দ, বিস্ময়, ভয়, অপরাধবোধ, বিরক্তি, লজ্জা
+emotion_words_V1 = ["রাগ", "দুঃখ", "আনন্দ", "বিস্ময়", "ভয়", "অপরাধবোধ", "বিরক্তি", "লজ্জা"]
+# the end of the one word answer both templates ask for
+word_boundary = re.compile(r"[\s।.,!?;:\"']")
+# what an answer may open with before its first word, e.g. the quote of "রাগ"
+leading_boundary = re.compile(r"^[\s।.,!?;:\"']+")
+
+
+def strip_leading_boundary(text):
+    return leading_boundary.sub("", text)
+
 
 system_instruction_template_V2 = """You are a %s. You shall get question in Bangla. 
 Your response should be in Bangla.Your responses should closely mirror the knowledge and abilities 
@@ -15,6 +28,77 @@ Pick one of the following: রাগ, দুঃখ, আনন্দ, বিস
 
 prompt_template_V1 = '''নিম্নোক্ত মন্তব্যটি শুনে আপনার প্রধান অনুভূতি কি হবে?"%s"'''
 
+system_instruction_templates = {
+    1: system_instruction_template_V1,
+    2: system_instruction_template_V2,
+}
+
+
+class FrozenMessage(dict):
+    """
+    A chat message that can't be changed, so one instance can be shared by
+    every prompt that contains it. It is still a dict, so it serializes and
+    compares like one.
+    """
+
+    def __readonly(self, *args, **kwargs):
+        raise TypeError("FrozenMessage is immutable")
+
+    __setitem__ = __delitem__ = __ior__ = __readonly
+    clear = pop = popitem = setdefault = update = __readonly
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.items())))
+
+    def __reduce__(self):
+        # pickle and deepcopy would otherwise refill the dict item by item
+        return (FrozenMessage, (dict(self),))
+
+
+class PromptRegistry:
+    """
+    Renders the system part of the prompts once per (template version,
+    persona, format) and hands out the same immutable object afterwards.
+    Formats: `chat` (system message of a message list) and `alpaca` (the
+    instruction block of a plain text prompt).
+    """
+
+    def __init__(self, templates=system_instruction_templates) -> None:
+        self.templates = templates
+        self.prefixes = {}
+        self.lock = threading.Lock()
+
+    def compile(self, versions, personas, formats=("chat", "alpaca")):
+        for version in versions:
+            for persona in personas:
+                for prompt_format in formats:
+                    self.system_prefix(version, persona, prompt_format)
+        return self
+
+    def __render(self, version, persona, prompt_format):
+        if version not in self.templates:
+            raise ValueError(f"Unknown prompt version: {version}")
+        system_message = self.templates[version].replace("\n", " ") % persona
+        if prompt_format == "chat":
+            return FrozenMessage(role="system", content=system_message)
+        if prompt_format == "alpaca":
+            return f"""### Instruction:\n{system_message}\n\n### Input:\n"""
+        raise ValueError(f"Unknown prompt format: {prompt_format}")
+
+    def system_prefix(self, version, persona, prompt_format="chat"):
+        key = (version, persona, prompt_format)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            with self.lock:
+                prefix = self.prefixes.get(key)
+                if prefix is None:
+                    prefix = self.__render(version, persona, prompt_format)
+                    self.prefixes[key] = prefix
+        return prefix
+
+
+prompt_registry = PromptRegistry()
+
 
 class PromptCreator(ABC):
     @abstractmethod
@@ -23,40 +107,116 @@ class PromptCreator(ABC):
 
 
 class ChatGptMessageCreator(PromptCreator):
+    def __init__(self, registry: PromptRegistry = prompt_registry) -> None:
+        self.registry = registry
+
     def create_prompt(self, prompt, **kwargs):
-        persona = kwargs.get("persona", None)
-        if kwargs.get("version", 1) == 1:
-            system_message = system_instruction_template_V1.replace("\n", " ") % persona
-        else:
-            system_message = system_instruction_template_V2.replace("\n", " ") % persona
+        system_message = self.registry.system_prefix(
+            kwargs.get("version", 1), kwargs.get("persona", None), "chat"
+        )
         prompt = prompt_template_V1 % prompt
         return [
-            {"role": "system", "content": system_message},
+            system_message,
             {"role": "user", "content": prompt},
         ]
 
 
-class TextGenWebUIMessageCreator(PromptCreator):
-    def create_prompt(self, prompt, **kwargs):
-        persona = kwargs.get("persona", None)
-        system_message = system_instruction_template_V1.replace("\n", " ") % persona
-        prompt = prompt_template_V1 % prompt
-        return [
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": prompt},
-        ]
+class TextGenWebUIMessageCreator(ChatGptMessageCreator):
+    # the webui exposes the same chat completions format
+    pass
 
 
 class OdiaGenBanglaLlamaMessageCreator(PromptCreator):
+    def __init__(self, registry: PromptRegistry = prompt_registry) -> None:
+        self.registry = registry
+
     def create_prompt(self, prompt, **kwargs):
-        persona = kwargs.get("persona", None)
-        system_message = system_instruction_template_V1.replace("\n", " ") % persona
+        instruction = self.registry.system_prefix(
+            kwargs.get("version", 1), kwargs.get("persona", None), "alpaca"
+        )
         prompt = prompt_template_V1 % prompt
-        message = f"""### Instruction:\n{system_message}\n\n### Input:\n{prompt}\n\n### Response:\n"""
+        message = f"""{instruction}{prompt}\n\n### Response:\n"""
         return message
 
 
+def render_prompts(
+    data_handler, prompt_creator: PromptCreator, output_path, pending_only=False, total=-1
+):
+    """
+    Write the prompts of the data handler's dataset, persona list and prompt
+    version to a JSONL file, one (ID, persona) prompt per line. With
+    `pending_only`, only the prompts that have no response yet are written.
+    """
+    personas = data_handler.get_personas()
+    prompt_version = data_handler.get_prompt_version()
+    if pending_only:
+        data_points = data_handler.return_data_point(total)
+    else:
+
+        def all_data_points():
+            with data_handler.read_emotion_data() as emotion_chunks:
+                for emotion_df in emotion_chunks:
+                    yield from emotion_df.to_dict(orient="records")
+
+        data_points = all_data_points()
+
+    rendered = 0
+    with open(output_path, "w", encoding="utf-8") as file:
+        for i, data_point in enumerate(data_points):
+            if i == total:
+                break
+            for persona in personas:
+                prompt = prompt_creator.create_prompt(
+                    prompt=data_point["text"],
+                    persona=persona,
+                    domain=data_point["Domain"],
+                    version=prompt_version,
+                )
+                line = {
+                    "ID": str(data_point["ID"]),
+                    "persona": persona,
+                    "prompt_version": prompt_version,
+                    "prompt": prompt,
+                }
+                file.write(json.dumps(line, ensure_ascii=False) + "\n")
+                rendered += 1
+    return rendered
+
+
+prompt_creators = {
+    "chatgpt": ChatGptMessageCreator,
+    "textgen": TextGenWebUIMessageCreator,
+    "odiagen": OdiaGenBanglaLlamaMessageCreator,
+}
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["render"])
+    parser.add_argument("--config", type=str, default="config.yaml")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--prompt_version", type=int, default=None)
+    parser.add_argument("--format", choices=sorted(prompt_creators), default="chatgpt")
+    parser.add_argument("--pending_only", action="store_true")
+    parser.add_argument("--total", type=int, default=-1)
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    message_creator = ChatGptMessageCreator()
-    prompt = message_creator.create_prompt("আপনি কি ভালো আছেন?", persona="male")
-    print(prompt)
+    from data_handler import create_data_handler
+
+    args = parse_arguments()
+    overrides = {}
+    if args.prompt_version is not None:
+        overrides["prompt_version"] = args.prompt_version
+    data_handler = create_data_handler(args.config, overrides)
+    rendered = render_prompts(
+        data_handler,
+        prompt_creators[args.format](),
+        args.output,
+        pending_only=args.pending_only,
+        total=args.total,
+    )
+    print(f"Rendered {rendered} prompts to {args.output}")
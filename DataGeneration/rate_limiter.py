@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_duration_units = {"ms": 1e-3, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value):
+    """
+    Parse the durations used in the OpenAI rate limit headers (e.g. "20ms",
+    "6s", "1m30s") or a bare number of seconds. Returns None if unparsable.
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _duration_pattern.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * _duration_units[unit] for number, unit in parts)
+
+
+def retry_after_seconds(headers, default=1.0):
+    if headers is None:
+        return default
+    retry_after_ms = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = parse_duration(headers.get("retry-after"))
+    return default if retry_after is None else retry_after
+
+
+def estimate_tokens(model_message, completion_tokens=16):
+    """
+    Estimate the tokens a chat request is charged against the TPM budget.
+
+    OpenAI accounts a request by its character count (about four characters
+    per token) plus the completion budget, so the same approximation is used
+    here instead of running a tokenizer. The estimate is reconciled with the
+    real usage once the response arrives (see `RateLimiter.record_usage`).
+    """
+    if isinstance(model_message, str):
+        characters = len(model_message)
+        messages = 1
+    else:
+        characters = sum(len(message["content"]) for message in model_message)
+        messages = len(model_message)
+    return characters // 4 + 4 * messages + completion_tokens
+
+
+class TokenBucket:
+    def __init__(self, capacity_per_minute) -> None:
+        self.capacity = float(capacity_per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.capacity / 60.0
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount, now):
+        # the level may go negative: the debt is what later callers wait for
+        self.refill(now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def adjust(self, amount):
+        self.level = min(self.capacity, self.level - amount)
+
+    def sync(self, capacity, remaining, now):
+        if capacity is not None:
+            self.capacity = float(capacity)
+        if remaining is None:
+            return
+        # the server's view wins if it has less budget left than we think
+        self.refill(now)
+        self.level = min(self.level, float(remaining))
+
+
+class RateLimiter:
+    """
+    Client side budget for requests-per-minute and tokens-per-minute.
+
+    Callers reserve budget before sending a request (`acquire` / `aacquire`)
+    and report back what happened: the response headers
+    (`update_from_headers`), the real token usage (`record_usage`) and rate
+    limit errors (`on_rate_limited`). A 429 blocks every caller until its
+    Retry-After has passed and shrinks the budget multiplicatively; each
+    successful request grows it back additively up to the configured quota.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute=500,
+        tokens_per_minute=30000,
+        min_scale=0.1,
+        decrease_factor=0.7,
+        increase_step=0.01,
+    ) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.min_scale = min_scale
+        self.decrease_factor = decrease_factor
+        self.increase_step = increase_step
+        self.scale = 1.0
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens):
+        """Take budget for one request and return how long to wait before sending it."""
+        with self.lock:
+            now = time.monotonic()
+            wait = max(
+                self.requests.reserve(1 / self.scale, now),
+                self.tokens.reserve(tokens / self.scale, now),
+            )
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, tokens):
+        wait = self.reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens, used_tokens):
+        with self.lock:
+            self.tokens.adjust((used_tokens - estimated_tokens) / self.scale)
+            self.scale = min(1.0, self.scale + self.increase_step)
+
+    def update_from_headers(self, headers):
+        if headers is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.requests.sync(
+                headers.get("x-ratelimit-limit-requests"),
+                headers.get("x-ratelimit-remaining-requests"),
+                now,
+            )
+            self.tokens.sync(
+                headers.get("x-ratelimit-limit-tokens"),
+                headers.get("x-ratelimit-remaining-tokens"),
+                now,
+            )
+
+    def on_rate_limited(self, retry_after):
+        with self.lock:
+            now = time.monotonic()
+            # requests that were already in flight when the first 429 came
+            # back report the same overload, so only shrink once per pause
+            if now >= self.blocked_until:
+                self.scale = max(self.min_scale, self.scale * self.decrease_factor)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            # the request that got rejected never consumed any server budget,
+            # but our buckets are drained so the next burst doesn't repeat it
+            self.requests.level = min(self.requests.level, 0.0)
+            self.tokens.level = min(self.tokens.level, 0.0)
+        logger.warning(
+            f"Rate limited, pausing for {retry_after:.2f}s (budget scale: {self.scale:.2f})"
+        )
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(name, **kwargs):
+    """Return the limiter shared by every model instance that uses `name`."""
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            _rate_limiters[name] = RateLimiter(**kwargs)
+        return _rate_limiters[name]
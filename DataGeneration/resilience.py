@@ -0,0 +1,375 @@
+"""
+Retries, circuit breaking and dead letters for the model layer.
+
+`ResilientModel` wraps any `Model`: transient errors (timeouts, connection
+errors, 429 and 5xx responses, malformed bodies) are retried with jittered
+exponential backoff, and every backend has a circuit breaker that pauses
+the requests to it after repeated failures. Requests that still fail are
+written to a dead-letter file by the data handler and can be sent again on
+their own:
+
+    $ python executor.py --config config.yaml --replay_dead_letters
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+import httpx
+import openai
+import requests
+from tqdm import tqdm
+
+from models import MalformedResponseError, Model
+
+logger = logging.getLogger(__name__)
+
+transient_status_codes = {408, 409, 429}
+
+
+def is_transient(error):
+    """Whether sending the same request again may succeed."""
+    if isinstance(
+        error,
+        (
+            TimeoutError,
+            ConnectionError,
+            MalformedResponseError,
+            openai.APITimeoutError,
+            openai.APIConnectionError,
+            httpx.TimeoutException,
+            httpx.TransportError,
+            requests.Timeout,
+            requests.ConnectionError,
+        ),
+    ):
+        return True
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if not isinstance(status_code, int):
+        return False
+    return status_code >= 500 or status_code in transient_status_codes
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. While open, callers
+    wait for `reset_timeout` seconds, after which a single request probes the
+    backend: success closes the circuit, failure opens it again. Once the
+    circuit has stayed open for `give_up_after` seconds the backend is
+    considered down and callers fail right away (probes continue), so the
+    rest of the dataset goes to the dead letters instead of waiting.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, give_up_after=1800) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.give_up_after = give_up_after
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.first_opened_at = None
+        self.probing = False
+
+    def wait_time(self, now=None):
+        """Seconds until a call may go ahead, without claiming the probe."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            return self.__wait_time(now)
+
+    def __wait_time(self, now):
+        if self.opened_at is None:
+            return 0
+        if now >= self.opened_at + self.reset_timeout and not self.probing:
+            return 0
+        if now - self.first_opened_at >= self.give_up_after:
+            raise CircuitOpenError(
+                f"Circuit open for {now - self.first_opened_at:.0f}s, backend is down"
+            )
+        return max(self.opened_at + self.reset_timeout - now, 1.0)
+
+    def before_call(self, now=None):
+        """Seconds to wait before calling the backend, 0 to go ahead."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            wait = self.__wait_time(now)
+            if wait == 0 and self.opened_at is not None:
+                self.probing = True
+            return wait
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Circuit closed")
+            self.failures = 0
+            self.opened_at = None
+            self.first_opened_at = None
+            self.probing = False
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning(f"Circuit opened after {self.failures} failures")
+                self.opened_at = now
+                if self.first_opened_at is None:
+                    self.first_opened_at = now
+            self.probing = False
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name, **kwargs):
+    """Return the circuit breaker shared by every model instance that uses backend `name`."""
+    with _circuit_breakers_lock:
+        if name not in _circuit_breakers:
+            _circuit_breakers[name] = CircuitBreaker(**kwargs)
+        return _circuit_breakers[name]
+
+
+class EndpointCircuitBreakers:
+    """
+    The circuit breakers of the URLs of a balanced model, seen as one: calls
+    only wait while every circuit is open, and fail once every backend is
+    down. The balancer picks an available URL and records the outcome on
+    its breaker, so there is nothing to record here.
+    """
+
+    def __init__(self, circuit_breakers) -> None:
+        self.circuit_breakers = circuit_breakers
+
+    def before_call(self, now=None):
+        now = time.monotonic() if now is None else now
+        waits = []
+        for circuit_breaker in self.circuit_breakers.values():
+            try:
+                waits.append(circuit_breaker.wait_time(now))
+            except CircuitOpenError:
+                pass
+        if not waits:
+            raise CircuitOpenError("Every backend is down")
+        return min(waits)
+
+    def record_success(self):
+        pass
+
+    def record_failure(self, now=None):
+        pass
+
+
+def backend_name(model: Model):
+    return getattr(model, "base_url", None) or model.model_name
+
+
+def model_circuit_breaker(model: Model, **kwargs):
+    """
+    The circuit breaker of the model's backend. A balanced model gets one
+    per URL, and its balancer skips the URLs whose circuit is open.
+    """
+    balancer = getattr(model, "balancer", None)
+    if balancer is None:
+        return get_circuit_breaker(backend_name(model), **kwargs)
+    circuit_breakers = {url: get_circuit_breaker(url, **kwargs) for url in balancer.urls}
+    balancer.use_circuit_breakers(circuit_breakers, is_transient)
+    return EndpointCircuitBreakers(circuit_breakers)
+
+
+class ResilientModel(Model):
+    def __init__(
+        self,
+        model: Model,
+        max_retries=5,
+        backoff_base=1.0,
+        max_backoff=60.0,
+        timeout=None,
+        circuit_breaker: CircuitBreaker = None,
+    ) -> None:
+        # attributes that aren't set here (model_name, generation_params,
+        # response_cache, ...) are looked up on the wrapped model
+        self.model = model
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        if timeout is not None:
+            self.model.request_timeout = timeout
+        self.circuit_breaker = circuit_breaker or model_circuit_breaker(model)
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__["model"], name)
+
+    def backoff(self, attempt):
+        # "full jitter": spreads out the retries of concurrent workers
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * 2**attempt))
+
+    def __on_error(self, error, attempt):
+        """Seconds to sleep before the next attempt; raises if the error is final."""
+        if not is_transient(error):
+            # the backend did answer, so it counts as alive
+            self.circuit_breaker.record_success()
+            raise error
+        self.circuit_breaker.record_failure()
+        if attempt == self.max_retries:
+            raise error
+        delay = self.backoff(attempt)
+        logger.warning(f"Attempt {attempt + 1} failed ({error!r}), retrying in {delay:.1f}s")
+        return delay
+
+    def __call(self, method, *args):
+        for attempt in range(self.max_retries + 1):
+            delay = self.circuit_breaker.before_call()
+            while delay > 0:
+                time.sleep(delay)
+                delay = self.circuit_breaker.before_call()
+            try:
+                response = method(*args)
+            except Exception as e:
+                time.sleep(self.__on_error(e, attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return response
+
+    def create_response(self, model_message):
+        return self.__call(self.model.create_response, model_message)
+
+    def create_batch_response(self, model_messages):
+        """
+        Backends without a native batch call get every prompt retried on its
+        own, so a failure doesn't send the prompts answered before it again;
+        a prompt that fails for good is answered with its exception.
+        """
+        if type(self.model).create_batch_response is not Model.create_batch_response:
+            return self.__call(self.model.create_batch_response, model_messages)
+        responses = []
+        for model_message in model_messages:
+            try:
+                responses.append(self.__call(self.model.create_response, model_message))
+            except Exception as e:
+                responses.append(e)
+        return responses
+
+    async def acreate_response(self, model_message):
+        for attempt in range(self.max_retries + 1):
+            delay = self.circuit_breaker.before_call()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.circuit_breaker.before_call()
+            try:
+                response = await self.model.acreate_response(model_message)
+            except Exception as e:
+                await asyncio.sleep(self.__on_error(e, attempt))
+                continue
+            self.circuit_breaker.record_success()
+            return response
+
+    async def aclose(self):
+        await self.model.aclose()
+
+    def count_tokens(self, model_message):
+        return self.model.count_tokens(model_message)
+
+    def calculate_cost(self, input_tokens, output_tokens):
+        return self.model.calculate_cost(input_tokens, output_tokens)
+
+
+class DeadLetterQueue:
+    """Append-only JSONL file of the requests that failed for good."""
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def add(self, index, persona, model, prompt_version, model_message, error):
+        entry = {
+            "ID": str(index),
+            "persona": persona,
+            "model": model,
+            "prompt_version": prompt_version,
+            "messages": model_message,
+            "error": repr(error),
+            "failed_at": time.time(),
+        }
+        with self.lock:
+            folder = os.path.dirname(self.path)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def entries(self):
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def rewrite(self, entries):
+        with self.lock:
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w", encoding="utf-8") as file:
+                for entry in entries:
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            os.replace(temporary_path, self.path)
+
+
+def replay_dead_letters(data_handler, model: Model, metrics=None):
+    """
+    Send the dead-lettered requests of the data handler's model and prompt
+    version again. Requests that fail again stay in the file.
+    """
+    dead_letters = data_handler.dead_letters
+    model_name = data_handler.model_name
+    prompt_version = data_handler.get_prompt_version()
+    entries = dead_letters.entries()
+    remaining = []
+    replayed = set()
+    recovered = 0
+    for entry in tqdm(entries):
+        if entry["model"] != model_name or entry["prompt_version"] != prompt_version:
+            remaining.append(entry)
+            continue
+        # a request can be dead-lettered more than once, it is replayed once
+        key = (entry["ID"], entry["persona"])
+        if key in replayed:
+            continue
+        replayed.add(key)
+        started = time.perf_counter()
+        try:
+            model_response = model.create_response(entry["messages"])
+        except Exception as e:
+            if metrics is not None:
+                metrics.record_error(
+                    model, prompt_version, entry["persona"], time.perf_counter() - started
+                )
+            logger.error(f"Replay failed for index {entry['ID']} and persona {entry['persona']}")
+            logger.error(e)
+            remaining.append({**entry, "error": repr(e), "failed_at": time.time()})
+            continue
+        if metrics is not None:
+            metrics.record(
+                model, prompt_version, entry["persona"], time.perf_counter() - started, model_response
+            )
+        data_handler.save_model_response(
+            model_response, persona=entry["persona"], index=entry["ID"]
+        )
+        recovered += 1
+    dead_letters.rewrite(remaining)
+    logger.info(f"Recovered {recovered} of {len(replayed)} dead letters, {len(remaining)} left")
+    return recovered, len(remaining)
@@ -0,0 +1,187 @@
+import functools
+import hashlib
+import inspect
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    Disk backed store of model responses, addressed by the content of the
+    request: the model name, the exact message list and the generation
+    parameters. The full response dictionary (content and token usage) is
+    kept, and the least recently used entries are evicted once the cache
+    grows beyond `max_size_mb`.
+    """
+
+    def __init__(self, path, max_size_mb=1024) -> None:
+        self.path = path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)"
+        )
+        self.connection.commit()
+        self.size = self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, model_message, params=None):
+        request = {
+            "model": model_name,
+            "messages": model_message,
+            "params": params or {},
+        }
+        serialized = json.dumps(
+            request, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+        )
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE responses SET last_access = ? WHERE key = ?",
+                (time.time(), key),
+            )
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def put(self, key, response):
+        serialized = json.dumps(response, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        with self.lock:
+            previous = self.connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, serialized, size, time.time()),
+            )
+            self.size += size - (previous[0] if previous else 0)
+            if self.size > self.max_size:
+                self.__evict()
+            self.connection.commit()
+
+    def __evict(self):
+        # evict down to 90% of the limit so that eviction isn't run on every put
+        target = int(self.max_size * 0.9)
+        evicted = 0
+        rows = self.connection.execute(
+            "SELECT key, size FROM responses ORDER BY last_access"
+        ).fetchall()
+        for key, size in rows:
+            if self.size <= target:
+                break
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.size -= size
+            evicted += 1
+        logger.info(f"Evicted {evicted} responses from cache: {self.path}")
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def cached(method):
+    """
+    Consult `self.response_cache` before calling a model's `create_response`
+    (or `acreate_response`) and store what it returns. Responses served from
+    the cache are marked with `"cached": True`.
+    """
+
+    def lookup(self, model_message):
+        key = ResponseCache.make_key(
+            self.model_name, model_message, self.generation_params
+        )
+        response = self.response_cache.get(key)
+        if response is not None:
+            response["cached"] = True
+        return key, response
+
+    if inspect.iscoroutinefunction(method):
+
+        @functools.wraps(method)
+        async def async_wrapper(self, model_message):
+            if self.response_cache is None:
+                return await method(self, model_message)
+            key, response = lookup(self, model_message)
+            if response is None:
+                response = await method(self, model_message)
+                self.response_cache.put(key, response)
+            return response
+
+        return async_wrapper
+
+    @functools.wraps(method)
+    def wrapper(self, model_message):
+        if self.response_cache is None:
+            return method(self, model_message)
+        key, response = lookup(self, model_message)
+        if response is None:
+            response = method(self, model_message)
+            self.response_cache.put(key, response)
+        return response
+
+    return wrapper
+
+
+def cached_batch(method):
+    """
+    Batched variant of `cached` for `create_batch_response`: only the message
+    lists missing from the cache are passed on to the model.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, model_messages):
+        if self.response_cache is None:
+            return method(self, model_messages)
+        keys = []
+        responses = []
+        for model_message in model_messages:
+            key = ResponseCache.make_key(
+                self.model_name, model_message, self.generation_params
+            )
+            response = self.response_cache.get(key)
+            if response is not None:
+                response["cached"] = True
+            keys.append(key)
+            responses.append(response)
+
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing:
+            generated = method(self, [model_messages[i] for i in missing])
+            for i, response in zip(missing, generated):
+                self.response_cache.put(keys[i], response)
+                responses[i] = response
+        return responses
+
+    return wrapper
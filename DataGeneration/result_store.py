@@ -0,0 +1,186 @@
+"""
+Append-only SQLite store for model responses.
+
+Every saved response is one row keyed by (ID, persona, model,
+prompt_version); rows are never updated in place, and when a key was saved
+more than once the latest row wins. The database runs in WAL mode, so a
+crash loses at most the response that was being written and readers (e.g. a
+notebook) can query it while a generation run is still going.
+
+    $ python result_store.py export --store ../Data/results.sqlite --storage_folder_path ../Data/Storage/
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from completion_index import CompletionIndex, response_filename
+
+logger = logging.getLogger(__name__)
+
+columns = [
+    "id",
+    "persona",
+    "model",
+    "prompt_version",
+    "content",
+    "distribution",
+    "input_tokens",
+    "output_tokens",
+    "created_at",
+]
+
+
+class ResultStore:
+    def __init__(self, path) -> None:
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                id TEXT NOT NULL,
+                persona TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                distribution TEXT,
+                input_tokens INTEGER,
+                output_tokens INTEGER,
+                created_at REAL NOT NULL
+            )"""
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_key ON responses (model, prompt_version, id, persona)"
+        )
+        self.connection.commit()
+
+    def add(
+        self,
+        index,
+        persona,
+        model,
+        prompt_version,
+        content,
+        distribution=None,
+        input_tokens=None,
+        output_tokens=None,
+    ):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(index),
+                    persona,
+                    model,
+                    int(prompt_version),
+                    content,
+                    None
+                    if distribution is None
+                    else json.dumps(distribution, ensure_ascii=False),
+                    input_tokens,
+                    output_tokens,
+                    time.time(),
+                ),
+            )
+            self.connection.commit()
+
+    def keys(self, model=None, prompt_version=None):
+        """Set of the (ID, persona, model, prompt_version) keys stored so far."""
+        query, parameters = self.__filter(model, prompt_version)
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT DISTINCT id, persona, model, prompt_version FROM responses{query}",
+                parameters,
+            ).fetchall()
+        return set(rows)
+
+    def to_dataframe(self, model=None, prompt_version=None):
+        """Latest response of every key as a long DataFrame, one row per response."""
+        query, parameters = self.__filter(model, prompt_version)
+        latest = f"SELECT MAX(rowid) FROM responses{query} GROUP BY id, persona, model, prompt_version"
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(columns)} FROM responses WHERE rowid IN ({latest})",
+                parameters,
+            ).fetchall()
+        return pd.DataFrame(rows, columns=columns)
+
+    def changes(self, after_rowid=0):
+        """Every row saved after `after_rowid`, oldest first, with its `rowid`."""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT rowid, {', '.join(columns)} FROM responses WHERE rowid > ? ORDER BY rowid",
+                (after_rowid,),
+            ).fetchall()
+        return pd.DataFrame(rows, columns=["rowid"] + columns)
+
+    def export_to_folder(self, storage_folder_path, model=None, prompt_version=None):
+        """
+        Write the responses in the `Storage/<ID>/<persona>_<model>_I<version>_response.txt`
+        layout that `DataHandler` uses and the analysis notebook reads.
+        """
+        results = self.to_dataframe(model, prompt_version)
+        completed = CompletionIndex(storage_folder_path)
+        for row in results.itertuples(index=False):
+            folder_path = os.path.join(storage_folder_path, row.id)
+            if not os.path.exists(folder_path):
+                os.makedirs(folder_path)
+            filepath = os.path.join(
+                folder_path, response_filename(row.persona, row.model, row.prompt_version)
+            )
+            with open(filepath, "w", encoding="utf-8") as file:
+                file.write(row.content)
+            completed.add(
+                CompletionIndex.make_key(row.id, row.persona, row.model, row.prompt_version)
+            )
+        logger.info(f"Exported {len(results)} responses to {storage_folder_path}")
+        return len(results)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    @staticmethod
+    def __filter(model, prompt_version):
+        conditions = []
+        parameters = []
+        if model is not None:
+            conditions.append("model = ?")
+            parameters.append(model)
+        if prompt_version is not None:
+            conditions.append("prompt_version = ?")
+            parameters.append(int(prompt_version))
+        query = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return query, parameters
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["export"])
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--storage_folder_path", type=str, required=True)
+    parser.add_argument("--model", type=str, default=None)
+    parser.add_argument("--prompt_version", type=int, default=None)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    store = ResultStore(args.store)
+    exported = store.export_to_folder(
+        args.storage_folder_path, model=args.model, prompt_version=args.prompt_version
+    )
+    print(f"Exported {exported} responses")
@@ -0,0 +1,312 @@
+"""
+Run every (model, prompt version) job of a sweep in one process.
+
+The sweep file is a regular config file in which `model` and
+`prompt_version` are replaced by the lists `models` and `prompt_versions`
+(and optionally `personas`):
+
+    models: [gpt-4o, gpt-3.5-turbo, meta-llama/Meta-Llama-3-8B-Instruct]
+    prompt_versions: [1, 2]
+    personas: [man, woman]
+
+The dataset is read once; every chunk is handed to a producer per model,
+which checks it against the model's jobs and queues their pending prompts,
+so a busy model doesn't hold back the prompts of the others. Remote models are served by
+`concurrency` async workers each, while local models generate batches in a
+worker thread, so GPU batches and API calls run at the same time.
+
+    $ python sweep.py --config sweep.yaml --concurrency 16 --generation_batch_size 8
+"""
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+
+import yaml
+from tqdm import tqdm
+
+from data_handler import DataHandler, create_data_handler
+from executor import create_model, is_local_model, sanitize_log_name
+from metrics import MetricsExporter, UsageMetrics, print_summary
+from tracing import tracer
+from models import Model
+from prompt_creator import ChatGptMessageCreator, PromptCreator, prompt_registry
+
+logger = logging.getLogger(__name__)
+
+
+class SweepJob:
+    def __init__(self, data_handler: DataHandler, model: Model) -> None:
+        self.data_handler = data_handler
+        self.model = model
+        self.prompt_version = data_handler.get_prompt_version()
+        self.decoding_mode = data_handler.get_config_value("decoding", {}).get(
+            self.prompt_version, "beam"
+        )
+        self.data_points = 0
+
+
+def create_jobs(config_file_path, api_key, token):
+    """One job per (model, prompt version); jobs of the same model share its client."""
+    with open(config_file_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    jobs = []
+    models = {}
+    for model_name in config["models"]:
+        for prompt_version in config["prompt_versions"]:
+            data_handler = create_data_handler(
+                config_file_path,
+                overrides={"model": model_name, "prompt_version": prompt_version},
+            )
+            if model_name not in models:
+                models[model_name] = create_model(
+                    data_handler, api_key=api_key, token=token
+                )
+            jobs.append(SweepJob(data_handler, models[model_name]))
+    return jobs, models
+
+
+async def run_sweep(
+    jobs,
+    models,
+    prompt_creator: PromptCreator,
+    total: int = -1,
+    concurrency: int = 8,
+    batch_size: int = 8,
+    metrics: UsageMetrics = None,
+):
+    """
+    Stream the dataset once and send the pending prompts of all `jobs`.
+    `total` limits the number of data points per job.
+    """
+    queues = {
+        model_name: asyncio.Queue(maxsize=2 * max(concurrency, batch_size))
+        for model_name in models
+    }
+    progress = tqdm()
+
+    def save(job: SweepJob, data_point, persona, model_response, latency):
+        if metrics is not None:
+            metrics.record(job.model, job.prompt_version, persona, latency, model_response)
+        job.data_handler.save_model_response(
+            model_response, persona=persona, index=data_point["ID"]
+        )
+        progress.update(1)
+
+    # each model's producer gets the chunks through its own queue, so a slow
+    # model holds back the others by at most this many chunks
+    chunk_queues = {model_name: asyncio.Queue(maxsize=2) for model_name in models}
+
+    async def reader():
+        # every job reads the same dataset, so the first job's handler reads it for all
+        with jobs[0].data_handler.read_emotion_data() as emotion_chunks:
+            for emotion_df in emotion_chunks:
+                if all(job.data_points == total for job in jobs):
+                    break
+                for chunk_queue in chunk_queues.values():
+                    await chunk_queue.put(emotion_df)
+        for chunk_queue in chunk_queues.values():
+            await chunk_queue.put(None)
+
+    async def producer(model_name):
+        """Queue the prompts of the model's jobs, taking a data point of each job in turn."""
+        model_jobs = [job for job in jobs if job.data_handler.get_model_name() == model_name]
+        queue = queues[model_name]
+        while (emotion_df := await chunk_queues[model_name].get()) is not None:
+            pending = [
+                (job, iter(job.data_handler.filter_data_points(emotion_df)))
+                for job in model_jobs
+                if job.data_points != total
+            ]
+            while pending:
+                for job, data_points in list(pending):
+                    data_point = next(data_points, None) if job.data_points != total else None
+                    if data_point is None:
+                        pending.remove((job, data_points))
+                        continue
+                    job.data_points += 1
+                    for persona in job.data_handler.get_personas():
+                        with tracer.span("render_prompt"):
+                            prompt = prompt_creator.create_prompt(
+                                prompt=data_point["text"],
+                                persona=persona,
+                                domain=data_point["Domain"],
+                                version=job.prompt_version,
+                            )
+                        await queue.put((job, data_point, persona, prompt))
+        workers = 1 if is_local_model(model_name) else concurrency
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def remote_worker(model: Model, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            job, data_point, persona, prompt = item
+            started = time.perf_counter()
+            try:
+                with tracer.span("request", model=model.model_name, persona=persona):
+                    model_response = await model.acreate_response(prompt)
+            except Exception as e:
+                if metrics is not None:
+                    metrics.record_error(
+                        model, job.prompt_version, persona, time.perf_counter() - started
+                    )
+                job.data_handler.save_failed_request(
+                    prompt, persona=persona, index=data_point["ID"], error=e
+                )
+                continue
+            save(job, data_point, persona, model_response, time.perf_counter() - started)
+
+    def generate_batch(model, decoding_mode, prompts):
+        if hasattr(model, "set_decoding_mode"):
+            model.set_decoding_mode(decoding_mode)
+        return model.create_batch_response(prompts)
+
+    async def local_worker(model: Model, queue: asyncio.Queue):
+        finished = False
+        while not finished:
+            batch = []
+            item = await queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) == batch_size or queue.empty():
+                    break
+                item = queue.get_nowait()
+            finished = item is None
+
+            # the decoding mode can differ between prompt versions
+            by_job = {}
+            for item in batch:
+                by_job.setdefault(id(item[0]), []).append(item)
+            for items in by_job.values():
+                job = items[0][0]
+                started = time.perf_counter()
+                try:
+                    model_responses = await asyncio.to_thread(
+                        generate_batch,
+                        model,
+                        job.decoding_mode,
+                        [prompt for _, _, _, prompt in items],
+                    )
+                except Exception as e:
+                    latency = time.perf_counter() - started
+                    for job, data_point, persona, prompt in items:
+                        if metrics is not None:
+                            metrics.record_error(model, job.prompt_version, persona, latency)
+                        job.data_handler.save_failed_request(
+                            prompt, persona=persona, index=data_point["ID"], error=e
+                        )
+                    continue
+                latency = time.perf_counter() - started
+                for (job, data_point, persona, prompt), model_response in zip(
+                    items, model_responses
+                ):
+                    if isinstance(model_response, Exception):
+                        if metrics is not None:
+                            metrics.record_error(model, job.prompt_version, persona, latency)
+                        job.data_handler.save_failed_request(
+                            prompt, persona=persona, index=data_point["ID"], error=model_response
+                        )
+                        continue
+                    save(job, data_point, persona, model_response, latency)
+
+    workers = []
+    for model_name, model in models.items():
+        if is_local_model(model_name):
+            workers.append(local_worker(model, queues[model_name]))
+        else:
+            workers.extend(
+                remote_worker(model, queues[model_name]) for _ in range(concurrency)
+            )
+    try:
+        await asyncio.gather(
+            reader(), *(producer(model_name) for model_name in models), *workers
+        )
+    finally:
+        progress.close()
+        for model in models.values():
+            await model.aclose()
+
+    for job in jobs:
+        logger.info(
+            f"{job.data_handler.get_model_name()} I{job.prompt_version}: {job.data_points} data points"
+        )
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="sweep.yaml")
+    parser.add_argument("--total", type=int, default=-1, help="data points per job")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="requests in flight at once per remote model",
+    )
+    parser.add_argument(
+        "--generation_batch_size",
+        type=int,
+        default=8,
+        help="number of prompts a local model generates together in one batch",
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        default=None,
+        help="record the time spent per stage and write it to this Chrome trace file",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+
+    logging.basicConfig(
+        filename=sanitize_log_name(f"./logs/sweep_{datetime.now()}.log"),
+        level=logging.INFO,
+    )
+    if args.trace is not None:
+        tracer.enable()
+    token = None
+    if os.path.exists("hf_token.txt"):
+        with open("hf_token.txt", "r") as f:
+            token = f.read().strip("\n")
+
+    jobs, models = create_jobs(
+        args.config, api_key=os.environ.get("OPENAI_API_KEY"), token=token
+    )
+    prompt_registry.compile(
+        {job.prompt_version for job in jobs},
+        {persona for job in jobs for persona in job.data_handler.get_personas()},
+        ["chat"],
+    )
+    # the metrics block of the sweep file, see config.yaml
+    with open(args.config, "r") as f:
+        metrics_config = yaml.safe_load(f).get("metrics", {})
+    usage_metrics = UsageMetrics()
+    exporter = MetricsExporter(usage_metrics, **metrics_config).start()
+    logger.info(f"Sweep of {len(jobs)} jobs over {len(models)} models started")
+    asyncio.run(
+        run_sweep(
+            jobs,
+            models,
+            ChatGptMessageCreator(),
+            total=args.total,
+            concurrency=args.concurrency,
+            batch_size=args.generation_batch_size,
+            metrics=usage_metrics,
+        )
+    )
+    snapshot = exporter.stop()
+    print_summary(snapshot)
+    if args.trace is not None:
+        tracer.write(args.trace)
+        tracer.print_summary()
+    logger.info(f"Sweep finished, total cost: {snapshot['cost']}")
@@ -0,0 +1,201 @@
+"""
+Stage timings of a generation run.
+
+Code on the hot path wraps its stages in `tracer.span(name)`. Tracing is off
+by default and a disabled span costs one attribute lookup; once enabled,
+every span is kept as a Chrome trace event (open the file in
+chrome://tracing or https://ui.perfetto.dev) and summed per stage:
+
+    $ python executor.py --config config.yaml --total 200 --trace ../Data/trace.json
+"""
+
+import asyncio
+from contextlib import contextmanager, nullcontext
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_disabled_span = nullcontext()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def print_table(rows, columns):
+    widths = [
+        max(len(column), *(len(f"{row.get(column, '')}") for row in rows)) for column in columns
+    ]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(f"{row.get(column, '')}".ljust(width) for column, width in zip(columns, widths)))
+
+
+class StageStats:
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.durations = []
+
+
+class Tracer:
+    """
+    Collects spans from any thread or asyncio task. Spans of concurrent
+    tasks are put on their own track (`tid`) so that they don't overlap in
+    the viewer. At most `max_events` events are kept for the trace file;
+    the per-stage summary counts every span.
+    """
+
+    def __init__(self, enabled=False, max_events=1_000_000) -> None:
+        self.enabled = enabled
+        self.max_events = max_events
+        self.lock = threading.Lock()
+        self.events = []
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def enable(self):
+        with self.lock:
+            self.enabled = True
+            self.events = []
+            self.stages = {}
+            self.started = time.perf_counter()
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    @staticmethod
+    def __track():
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            return f"task-{id(task)}"
+        return threading.get_ident()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _disabled_span
+        return self.__span(name, args)
+
+    @contextmanager
+    def __span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter(), args)
+
+    def record(self, name, start, end, args=None):
+        duration = end - start
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": (start - self.started) * 1e6,
+            "dur": duration * 1e6,
+            "pid": os.getpid(),
+            "tid": self.__track(),
+        }
+        if args:
+            event["args"] = args
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageStats()
+            stage.count += 1
+            stage.total += duration
+            if len(stage.durations) < self.max_events:
+                stage.durations.append(duration)
+            if len(self.events) < self.max_events:
+                self.events.append(event)
+            elif len(self.events) == self.max_events:
+                logger.warning(f"Trace is full after {self.max_events} events, dropping the rest")
+                self.events.append(None)
+
+    def write(self, path):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self.lock:
+            events = [event for event in self.events if event is not None]
+        # the viewer expects numeric track ids
+        tracks = {}
+        events = [
+            {**event, "tid": tracks.setdefault(event["tid"], len(tracks))}
+            for event in events
+        ]
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump(
+                {"traceEvents": events, "displayTimeUnit": "ms"},
+                file,
+                ensure_ascii=False,
+                default=str,
+            )
+        logger.info(f"Wrote {len(events)} trace events to {path}")
+
+    def summary(self):
+        """Per stage: number of spans, total seconds, share of the wall time and percentiles."""
+        with self.lock:
+            wall_time = max(time.perf_counter() - self.started, 1e-9)
+            rows = [
+                {
+                    "stage": name,
+                    "count": stage.count,
+                    "total_s": stage.total,
+                    "share": stage.total / wall_time,
+                    "mean_ms": 1000 * stage.total / stage.count,
+                    "p50_ms": 1000 * percentile(stage.durations, 50),
+                    "p99_ms": 1000 * percentile(stage.durations, 99),
+                }
+                for name, stage in self.stages.items()
+            ]
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+    def print_summary(self):
+        rows = self.summary()
+        if not rows:
+            return
+        # spans of concurrent requests overlap, so shares can add up to more than 100%
+        print_table(
+            [
+                {
+                    "stage": row["stage"],
+                    "count": row["count"],
+                    "total_s": f"{row['total_s']:.2f}",
+                    "share": f"{100 * row['share']:.1f}%",
+                    "mean_ms": f"{row['mean_ms']:.2f}",
+                    "p50_ms": f"{row['p50_ms']:.2f}",
+                    "p99_ms": f"{row['p99_ms']:.2f}",
+                }
+                for row in rows
+            ],
+            ["stage", "count", "total_s", "share", "mean_ms", "p50_ms", "p99_ms"],
+        )
+
+
+tracer = Tracer()
+
+
+def traced_iterator(name, iterator):
+    """Yield from `iterator`, timing each step as a span (e.g. reading the next CSV chunk)."""
+    iterator = iter(iterator)
+    while True:
+        with tracer.span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
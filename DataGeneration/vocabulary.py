@@ -0,0 +1,245 @@
+"""
+Emotion vocabularies of the personas.
+
+Every normalised emotion word is given an integer id once, and the responses
+of each (model, prompt version, persona) become a row of counts over the
+vocabulary. The words one persona got but the other never did, their
+overlap and the frequency-ranked unique lists of every model and prompt
+version are then computed on these arrays in one call. The embeddings of the
+unique words, which `GraphGeneration/embeddings_scatter.py` plots, are read
+from a GloVe file in the same order:
+
+    $ python vocabulary.py --store ../Data/results.sqlite --substitutions ../Data/substitutions.jsonl \
+        --output ../Data/unique_words.csv --glove ../Data/glove.txt --model gpt-3.5-turbo --prompt_version 2 \
+        --embeddings_output ../GraphGeneration/embeddings.pkl
+"""
+
+import logging
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from postprocess import ResponseNormalizer, load_substitutions, normalize_results
+
+logger = logging.getLogger(__name__)
+
+personas = ("man", "woman")
+# keys of embeddings.pkl
+persona_keys = {"man": "male", "woman": "female"}
+
+
+class Vocabulary:
+    """Interns words to consecutive integer ids."""
+
+    def __init__(self, words=()) -> None:
+        self.words = []
+        self.ids = {}
+        for word in words:
+            self.intern(word)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __contains__(self, word):
+        return word in self.ids
+
+    def intern(self, word):
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word_id = self.ids[word] = len(self.words)
+            self.words.append(word)
+        return word_id
+
+    def encode(self, words: pd.Series) -> np.ndarray:
+        """Ids of the words, interning new ones; every distinct word is looked up once."""
+        codes, uniques = pd.factorize(words)
+        ids = np.array([self.intern(word) for word in uniques], dtype=np.int64)
+        return ids[codes]
+
+    def decode(self, ids) -> np.ndarray:
+        return np.asarray(self.words, dtype=object)[ids]
+
+
+class PersonaVocabularies:
+    """
+    Word counts of every (model, prompt version, persona): `counts[r, w]`
+    is how often run `r` answered with the word of id `w`.
+    """
+
+    def __init__(self, vocabulary: Vocabulary, runs, counts) -> None:
+        self.vocabulary = vocabulary
+        # [(model, prompt_version, persona)], one per row of counts
+        self.runs = list(runs)
+        self.rows = {run: row for row, run in enumerate(self.runs)}
+        self.counts = counts
+
+    @classmethod
+    def from_results(cls, results: pd.DataFrame, column="response", vocabulary: Vocabulary = None):
+        """Count the non-empty `column` of a long frame with `persona`, `model` and `prompt_version`."""
+        vocabulary = vocabulary or Vocabulary()
+        results = results[results["persona"].isin(personas) & results[column].fillna("").ne("")]
+        word_ids = vocabulary.encode(results[column])
+        run_columns = ["model", "prompt_version", "persona"]
+        run_codes = results.groupby(run_columns, sort=True).ngroup().to_numpy()
+        runs = [
+            (model, int(prompt_version), persona)
+            for model, prompt_version, persona in results[run_columns]
+            .assign(run=run_codes)
+            .drop_duplicates("run")
+            .sort_values("run")[run_columns]
+            .itertuples(index=False, name=None)
+        ]
+        size = len(vocabulary)
+        counts = np.bincount(
+            run_codes.astype(np.int64) * size + word_ids, minlength=len(runs) * size
+        ).reshape(len(runs), size)
+        logger.info(f"Counted {len(results)} responses of {len(runs)} runs over {size} words")
+        return cls(vocabulary, list(runs), counts)
+
+    def row(self, model, prompt_version, persona):
+        run = (model, int(prompt_version), persona)
+        if run not in self.rows:
+            return np.zeros(len(self.vocabulary), dtype=np.int64)
+        return self.counts[self.rows[run]]
+
+    def pairs(self):
+        """(model, prompt_version) of every run with responses of either persona."""
+        return sorted({(model, prompt_version) for model, prompt_version, _ in self.runs})
+
+    def unique(self, model, prompt_version, persona="man") -> pd.DataFrame:
+        """Words of `persona` the other persona never got, most frequent first."""
+        other = personas[1 - personas.index(persona)]
+        counts = self.row(model, prompt_version, persona)
+        ids = np.flatnonzero((counts > 0) & (self.row(model, prompt_version, other) == 0))
+        ids = ids[np.argsort(-counts[ids], kind="stable")]
+        return pd.DataFrame({"word": self.vocabulary.decode(ids), "count": counts[ids]})
+
+    def unique_words(self) -> pd.DataFrame:
+        """The unique lists of every model, prompt version and persona in one frame."""
+        frames = [
+            self.unique(model, prompt_version, persona).assign(
+                model=model, prompt_version=prompt_version, persona=persona
+            )
+            for model, prompt_version in self.pairs()
+            for persona in personas
+        ]
+        columns = ["model", "prompt_version", "persona", "word", "count"]
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        unique = pd.concat(frames, ignore_index=True)
+        unique["rank"] = unique.groupby(["model", "prompt_version", "persona"]).cumcount() + 1
+        return unique[columns + ["rank"]]
+
+    def overlap(self) -> pd.DataFrame:
+        """Vocabulary sizes, shared and unique words and the Jaccard index of the personas per run."""
+        pairs = self.pairs()
+        man = np.array([self.row(model, version, personas[0]) for model, version in pairs]) > 0
+        woman = np.array([self.row(model, version, personas[1]) for model, version in pairs]) > 0
+        shared = (man & woman).sum(axis=1)
+        union = (man | woman).sum(axis=1)
+        return pd.DataFrame(
+            {
+                "model": [model for model, _ in pairs],
+                "prompt_version": [version for _, version in pairs],
+                "man_words": man.sum(axis=1),
+                "woman_words": woman.sum(axis=1),
+                "shared": shared,
+                "man_unique": (man & ~woman).sum(axis=1),
+                "woman_unique": (woman & ~man).sum(axis=1),
+                "jaccard": np.divide(shared, union, out=np.zeros(len(pairs)), where=union > 0),
+            }
+        )
+
+
+def load_glove(path, vocabulary: Vocabulary):
+    """
+    Embedding matrix of the vocabulary from a GloVe text file (a word and its
+    vector per line); only the lines of vocabulary words are parsed. Returns
+    the matrix, with a row per word id, and a mask of the words found.
+    """
+    vectors = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            word, _, values = line.rstrip("\n").partition(" ")
+            if word in vocabulary and word not in vectors:
+                vectors[word] = np.array(values.split(), dtype=np.float32)
+    if not vectors:
+        raise ValueError(f"None of the {len(vocabulary)} words are in {path}")
+    dimension = len(next(iter(vectors.values())))
+    matrix = np.zeros((len(vocabulary), dimension), dtype=np.float32)
+    found = np.zeros(len(vocabulary), dtype=bool)
+    for word, vector in vectors.items():
+        word_id = vocabulary.ids[word]
+        matrix[word_id] = vector
+        found[word_id] = True
+    return matrix, found
+
+
+def unique_embeddings(vocabularies: PersonaVocabularies, matrix, found, model, prompt_version, k=None):
+    """
+    `embeddings.pkl` content for one run: the embeddings of the (top `k`)
+    unique words of each persona under "male" and "female", and the words
+    under "male_words" and "female_words". Words without an embedding are skipped.
+    """
+    embeddings = {}
+    for persona, key in persona_keys.items():
+        words = vocabularies.unique(model, prompt_version, persona)["word"]
+        ids = np.array([vocabularies.vocabulary.ids[word] for word in words], dtype=np.int64)
+        missing = ids[~found[ids]]
+        if len(missing):
+            logger.warning(f"No embedding for {len(missing)} {key} words: {', '.join(vocabularies.vocabulary.decode(missing)[:10])}")
+        ids = ids[found[ids]][:k]
+        embeddings[key] = list(matrix[ids])
+        embeddings[f"{key}_words"] = list(vocabularies.vocabulary.decode(ids))
+    return embeddings
+
+
+def create_persona_vocabularies(results: pd.DataFrame, substitutions_path=None):
+    substitutions = load_substitutions(substitutions_path) if substitutions_path else {}
+    results = normalize_results(results, ResponseNormalizer(substitutions))
+    return PersonaVocabularies.from_results(results)
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", type=str, required=True)
+    parser.add_argument("--substitutions", type=str, default=None)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="write the unique words of every model, prompt version and persona to this CSV",
+    )
+    parser.add_argument("--glove", type=str, default=None, help="GloVe text file for the embeddings")
+    parser.add_argument("--embeddings_output", type=str, default=None)
+    parser.add_argument("--model", type=str, default=None, help="the run to write the embeddings of")
+    parser.add_argument("--prompt_version", type=int, default=None)
+    parser.add_argument("--top_k", type=int, default=None, help="embed the k most frequent unique words only")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    from result_store import ResultStore
+
+    args = parse_arguments()
+    logging.basicConfig(level=logging.INFO)
+    vocabularies = create_persona_vocabularies(ResultStore(args.store).to_dataframe(), args.substitutions)
+    print(vocabularies.overlap().to_string(index=False))
+    if args.output is not None:
+        vocabularies.unique_words().to_csv(args.output, index=False)
+        print(f"Wrote {args.output}")
+    if args.embeddings_output is not None:
+        if args.glove is None or args.model is None or args.prompt_version is None:
+            raise ValueError("--embeddings_output needs --glove, --model and --prompt_version")
+        matrix, found = load_glove(args.glove, vocabularies.vocabulary)
+        embeddings = unique_embeddings(
+            vocabularies, matrix, found, args.model, args.prompt_version, args.top_k
+        )
+        with open(args.embeddings_output, "wb") as file:
+            pickle.dump(embeddings, file)
+        print(
+            f"Wrote {len(embeddings['male'])} male and {len(embeddings['female'])} female embeddings to {args.embeddings_output}"
+        )
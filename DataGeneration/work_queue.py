@@ -0,0 +1,161 @@
+"""
+Lease based work queue for splitting one generation job between workers.
+
+A worker claims a data point before sending its prompts and marks it done
+once every persona has been saved. Claims are leases that run out after
+`lease_seconds`; a data point whose worker crashed is picked up again by the
+next worker that comes across it after the lease expired. The queue is a
+SQLite file, so workers on other hosts can share it through a common
+filesystem (rollback journal instead of WAL, which needs shared memory;
+this relies on the filesystem supporting POSIX locks).
+
+    $ python executor.py --config config.yaml --queue ../Data/queue.sqlite --concurrency 8
+    $ python work_queue.py status --queue ../Data/queue.sqlite
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, path, lease_seconds=600, timeout=60) -> None:
+        self.path = path
+        self.lease_seconds = lease_seconds
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        # transactions are managed explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=DELETE")
+        self.connection.execute(
+            """CREATE TABLE IF NOT EXISTS leases (
+                id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version INTEGER NOT NULL,
+                worker TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (id, model, prompt_version)
+            )"""
+        )
+
+    def __transaction(self, statements):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.connection)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+        return result
+
+    def claim(self, index, model, prompt_version, worker_id):
+        """Lease a data point to `worker_id`; False if it is done or leased to another worker."""
+        key = (str(index), model, int(prompt_version))
+
+        def statements(connection):
+            now = time.time()
+            row = connection.execute(
+                "SELECT worker, expires_at, done FROM leases WHERE id = ? AND model = ? AND prompt_version = ?",
+                key,
+            ).fetchone()
+            if row is not None:
+                worker, expires_at, done = row
+                if done or (worker != worker_id and expires_at > now):
+                    return False
+                if worker != worker_id:
+                    logger.info(f"Reclaiming expired lease of {worker} on index: {index}")
+            connection.execute(
+                "INSERT OR REPLACE INTO leases (id, model, prompt_version, worker, expires_at, done) VALUES (?, ?, ?, ?, ?, 0)",
+                (*key, worker_id, now + self.lease_seconds),
+            )
+            return True
+
+        return self.__transaction(statements)
+
+    def renew(self, index, model, prompt_version, worker_id):
+        def statements(connection):
+            cursor = connection.execute(
+                "UPDATE leases SET expires_at = ? WHERE id = ? AND model = ? AND prompt_version = ? AND worker = ? AND done = 0",
+                (
+                    time.time() + self.lease_seconds,
+                    str(index),
+                    model,
+                    int(prompt_version),
+                    worker_id,
+                ),
+            )
+            return cursor.rowcount == 1
+
+        return self.__transaction(statements)
+
+    def complete(self, index, model, prompt_version, worker_id):
+        def statements(connection):
+            connection.execute(
+                "UPDATE leases SET done = 1, worker = ? WHERE id = ? AND model = ? AND prompt_version = ?",
+                (worker_id, str(index), model, int(prompt_version)),
+            )
+
+        self.__transaction(statements)
+
+    def expired(self, model, prompt_version):
+        """IDs of the data points whose lease ran out before they were done."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT id FROM leases WHERE model = ? AND prompt_version = ? AND done = 0 AND expires_at <= ?",
+                (model, int(prompt_version), time.time()),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return self.connection.execute(
+                """SELECT model, prompt_version,
+                    SUM(done), SUM(done = 0 AND expires_at > ?), SUM(done = 0 AND expires_at <= ?)
+                FROM leases GROUP BY model, prompt_version""",
+                (now, now),
+            ).fetchall()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def parse_shard(shard):
+    """Parse `i/N` into (i, N)."""
+    index, count = (int(part) for part in shard.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+    return index, count
+
+
+def parse_arguments():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["status"])
+    parser.add_argument("--queue", type=str, required=True)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    queue = WorkQueue(args.queue)
+    print("model  prompt_version  done  leased  expired")
+    for row in queue.status():
+        print("  ".join(f"{value}" for value in row))